@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+from lxml import etree, html
+
+BOOK = 'book.asciidoc'
+OUTPUT = os.environ.get('BOOK_OUTPUT', 'book.html')
+# usually called from the Makefile with $(RUN_ASCIIDOCTOR), so both builds agree
+ASCIIDOCTOR = sys.argv[1:] or ['asciidoctor']
+CACHE_DIR = os.environ.get('BOOK_FRAGMENT_CACHE', os.path.expanduser(
+    '~/.cache/book-build/fragments'
+))
+
+INCLUDE = re.compile(r'^include::(?P<path>[^\[]+)\[.*\]\s*$')
+ATTRIBUTE = re.compile(r'^:(?P<name>[\w-]+?)(?P<unset>!?):\s*(?P<value>.*?)\s*$')
+# the header sets these up for the whole book, they mean nothing to a single chapter
+SHELL_ONLY_ATTRIBUTES = {'doctype', 'toc', 'toc-title', 'toclevels'}
+# asciidoctor seeds its section counters from these, which is how a chapter
+# rendered on its own still gets the right number.  footnotes are renumbered
+# in stitch() instead, so adding one doesn't re-render every later chapter
+COUNTERS = ['chapter-number', 'appendix-number']
+CHAPTER_NUMERAL = re.compile(r'^(\d+)\. ')
+APPENDIX_NUMERAL = re.compile(r'^\w+ ([A-Z]+): ')
+SECTION_NUMERAL = re.compile(r'^(\w+ [A-Z]+: |(\d+\.)+ |[A-Z]\.(\d+\.)* )')
+FOOTNOTE_ANCHOR = re.compile(r'^(#?_footnote(?:def|ref)_)(\d+)$')
+UNRESOLVED_XREF = re.compile(r'possible invalid reference')
+
+
+def parse_book(path):
+    # everything up to the first include is the book's header and goes into
+    # the page shell, after that it's chapter includes and attribute changes
+    header = []
+    includes = []
+    attributes = {}
+    for line in open(path, encoding='utf8'):
+        include = INCLUDE.match(line)
+        if include:
+            includes.append((include.group('path'), dict(attributes)))
+            continue
+        if not includes:
+            header.append(line)
+        attribute = ATTRIBUTE.match(line)
+        if attribute:
+            value = None if attribute.group('unset') else attribute.group('value')
+            attributes[attribute.group('name')] = value
+        elif includes and line.strip():
+            print(f'WARNING: ignoring text between includes in {path}: {line.strip()}')
+    return ''.join(header), includes, attributes
+
+
+def include_graph_hash(path, sha=None, seen=None):
+    sha = sha or hashlib.sha1()
+    seen = seen if seen is not None else set()
+    if path in seen:
+        return sha
+    seen.add(path)
+    sha.update(path.encode('utf8') + b'\0')
+    try:
+        with open(path, 'rb') as f:
+            contents = f.read()
+    except OSError:
+        sha.update(b'missing\0')
+        return sha
+    sha.update(contents + b'\0')
+    for line in contents.decode('utf8').splitlines():
+        include = INCLUDE.match(line)
+        if include:
+            include_graph_hash(os.path.join(os.path.dirname(path), include.group('path')), sha, seen)
+    return sha
+
+
+def get_toolchain_hash():
+    version = subprocess.run(ASCIIDOCTOR[:1] + ['--version'], stdout=subprocess.PIPE).stdout
+    sha = hashlib.sha1(version)
+    sha.update(json.dumps(ASCIIDOCTOR).encode('utf8'))
+    with open(os.path.abspath(__file__), 'rb') as f:
+        sha.update(f.read())
+    return sha
+
+
+def run_asciidoctor(args, input=None):
+    result = subprocess.run(
+        ASCIIDOCTOR + args + ['-o', '-'],
+        input=input, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    )
+    for line in result.stderr.decode('utf8').splitlines():
+        # xrefs to other chapters can't resolve yet, stitch() fills those in
+        if not UNRESOLVED_XREF.search(line):
+            print(line)
+    if result.returncode:
+        raise SystemExit(f'asciidoctor failed: {" ".join(args)}')
+    return result.stdout.decode('utf8')
+
+
+def render_cached(key, render):
+    path = os.path.join(CACHE_DIR, key + '.json')
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+    rendered = render()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(rendered, f)
+    os.replace(path + '.tmp', path)
+    return rendered
+
+
+def attribute_args(attributes):
+    args = []
+    for name, value in sorted(attributes.items()):
+        if value is not None and name not in SHELL_ONLY_ATTRIBUTES:
+            # soft-set, so a chapter can still change them itself
+            args += ['-a', f'{name}={value}@']
+    return args
+
+
+def count_numerals(fragment_html, counters):
+    counters = dict(counters)
+    fragment = html.fragment_fromstring(fragment_html, create_parent='div')
+    for heading in fragment.cssselect('div.sect1 > h2'):
+        text = heading.text_content()
+        chapter = CHAPTER_NUMERAL.match(text)
+        appendix = APPENDIX_NUMERAL.match(text)
+        if chapter:
+            counters['chapter-number'] = int(chapter.group(1))
+        elif appendix:
+            counters['appendix-number'] = appendix.group(1)
+    return counters
+
+
+def render_fragment(path, attributes, counters, toolchain_hash):
+    sha = toolchain_hash.copy()
+    sha.update(json.dumps([attributes, counters], sort_keys=True).encode('utf8'))
+    include_graph_hash(path, sha)
+
+    def render():
+        print('rendering', path)
+        args = ['-e', '-d', attributes.get('doctype') or 'book'] + attribute_args(attributes)
+        for name in COUNTERS:
+            if counters[name]:
+                args += ['-a', f'{name}={counters[name]}']
+        fragment_html = run_asciidoctor(args + [path])
+        return {'html': fragment_html, 'counters': count_numerals(fragment_html, counters)}
+
+    return render_cached(sha.hexdigest(), render)
+
+
+def render_shell(header, toolchain_hash):
+    sha = toolchain_hash.copy()
+    sha.update(header.encode('utf8'))
+    return render_cached(sha.hexdigest(), lambda: {
+        'html': run_asciidoctor(['-'], input=header.encode('utf8'))
+    })['html']
+
+
+def renumber_footnotes(fragment, offset):
+    # every fragment numbers its own footnotes from 1, the book carries on
+    # from the last fragment's.  returns where the next one carries on from
+    last = offset
+    for element in fragment.iter():
+        if not isinstance(element.tag, str):
+            continue
+        for attribute in ('id', 'href'):
+            anchor = FOOTNOTE_ANCHOR.match(element.get(attribute) or '')
+            if anchor:
+                number = int(anchor.group(2)) + offset
+                element.set(attribute, f'{anchor.group(1)}{number}')
+                last = max(last, number)
+    # the numbers shown, in the text and at the start of each footnote
+    for link in fragment.cssselect('sup a.footnote, #footnotes div.footnote > a'):
+        if link.text and link.text.isdigit():
+            link.text = str(int(link.text) + offset)
+    return last
+
+
+def dedupe_ids(fragment, seen_ids):
+    # asciidoctor would have suffixed repeated generated ids across the
+    # whole book, we have to do the same for each fragment after the first
+    renamed = {}
+    for element in fragment.iter():
+        id = element.get('id') if isinstance(element.tag, str) else None
+        if id is None:
+            continue
+        if id in seen_ids:
+            number = 2
+            while f'{id}_{number}' in seen_ids:
+                number += 1
+            renamed[id] = f'{id}_{number}'
+            element.set('id', renamed[id])
+        seen_ids.add(element.get('id'))
+    for link in fragment.cssselect('a[href^="#"]'):
+        anchor = link.get('href')[1:]
+        if anchor in renamed:
+            link.set('href', '#' + renamed[anchor])
+
+
+def xref_text(target):
+    if target.tag in ('h1', 'h2', 'h3', 'h4', 'h5', 'h6'):
+        return SECTION_NUMERAL.sub('', target.text_content().strip())
+    titles = target.cssselect('.title')
+    if titles:
+        return titles[0].text_content().strip()
+    return None
+
+
+def fix_xrefs(content):
+    targets = {element.get('id'): element for element in content.cssselect('[id]')}
+    for link in content.cssselect('a[href^="#"]'):
+        anchor = link.get('href')[1:]
+        if anchor in targets and link.text_content() == f'[{anchor}]':
+            text = xref_text(targets[anchor])
+            if text:
+                for child in list(link):
+                    link.remove(child)
+                link.text = text
+
+
+def build_toc(content, title):
+    toc = html.fragment_fromstring(
+        '<div id="toc" class="toc"><div id="toctitle"></div></div>'
+    )
+    toc[0].text = title
+    # [level, element the next list goes in, that list once made]
+    stack = [[-1, toc, None]]
+    for heading in content.cssselect('h1.sect0, div.sect1 > h2, div.sect2 > h3'):
+        level = int(heading.tag[1]) - 1
+        while stack[-1][0] >= level:
+            stack.pop()
+        parent = stack[-1]
+        if parent[2] is None:
+            parent[2] = etree.SubElement(parent[1], 'ul', {'class': f'sectlevel{level}'})
+        item = etree.SubElement(parent[2], 'li')
+        link = etree.SubElement(item, 'a', href='#' + heading.get('id'))
+        link.text = heading.text_content()
+        stack.append([level, item, None])
+    return toc
+
+
+def stitch(shell_html, fragment_htmls, toc_title):
+    page = html.document_fromstring(shell_html)
+    content = page.get_element_by_id('content')
+    seen_ids = {element.get('id') for element in page.cssselect('[id]')}
+    footnotes = []
+    footnote_number = 0
+    for fragment_html in fragment_htmls:
+        fragment = html.fragment_fromstring(fragment_html, create_parent='div')
+        footnote_number = renumber_footnotes(fragment, footnote_number)
+        # each fragment comes with its own footnotes list, the book gets one at the end
+        for footnotes_div in fragment.cssselect('#footnotes'):
+            footnotes.extend(footnotes_div.cssselect('div.footnote'))
+            footnotes_div.drop_tree()
+        dedupe_ids(fragment, seen_ids)
+        content.extend(list(fragment))
+    fix_xrefs(content)
+    if footnotes:
+        footnotes_div = html.fragment_fromstring('<div id="footnotes"><hr></div>')
+        footnotes_div.extend(footnotes)
+        content.addnext(footnotes_div)
+    page.get_element_by_id('header').append(build_toc(content, toc_title))
+    return html.tostring(page, doctype='<!DOCTYPE html>', encoding='unicode')
+
+
+def main():
+    header, includes, book_attributes = parse_book(BOOK)
+    toolchain_hash = get_toolchain_hash()
+    shell_html = render_shell(header, toolchain_hash)
+    counters = dict.fromkeys(COUNTERS)
+    fragment_htmls = []
+    for path, attributes in includes:
+        if not os.path.exists(path):
+            print(f'WARNING: {BOOK} includes missing file {path}')
+            continue
+        fragment = render_fragment(path, attributes, counters, toolchain_hash)
+        fragment_htmls.append(fragment['html'])
+        counters = fragment['counters']
+    toc_title = book_attributes.get('toc-title') or 'Table of Contents'
+    with open(OUTPUT + '.tmp', 'w', encoding='utf8') as f:
+        f.write(stitch(shell_html, fragment_htmls, toc_title))
+    os.replace(OUTPUT + '.tmp', OUTPUT)
+
+
+if __name__ == '__main__':
+    main()
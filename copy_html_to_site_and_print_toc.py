@@ -1,11 +1,29 @@
 #!/usr/bin/env python
 
-from collections import namedtuple
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from functools import lru_cache
+import gzip
+import hashlib
 import os
 import json
-from lxml import html
+from lxml import etree, html
+import re
+import shutil
+import struct
 import subprocess
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
 CHAPTERS = [
     c.replace('.asciidoc', '.html')
     for c in json.loads(open('atlas.json').read())['files']
@@ -20,18 +38,56 @@ CHAPTERS.remove('ix.html')
 CHAPTERS.remove('author_bio.html')
 CHAPTERS.remove('colo.html')
 
-ChapterInfo = namedtuple('ChapterInfo', 'href_id chapter_title subheaders xrefs')
+ChapterInfo = namedtuple('ChapterInfo', 'href_id chapter_title subheaders xrefs links images search_shard')
+ImageInfo = namedtuple('ImageInfo', 'digest width height')
+
+MAKE_JOBS = int(os.environ.get('MAKE_JOBS', os.cpu_count() or 1))
+TARGET_DIR = '/home/harry/workspace/www.obeythetestinggoat.com/content/book'
+# input hashes of each published chapter, delete it to force a full republish
+MANIFEST_PATH = os.path.join(TARGET_DIR, '.publish-manifest.json')
+# these get content-hashed filenames, so the site can serve them with a
+# far-future cache header
+STATIC_ASSETS = ['asciidoctor.css', 'coderay-asciidoctor.css', 'load_toc.js', 'search.js']
+SHARED_INPUTS = [
+    'disqus_comments.html',
+    'buy_the_book_banner.html',
+    'analytics.html',
+] + STATIC_ASSETS + [
+    os.path.abspath(__file__),
+]
+# resized copies offered in srcset, only made when Pillow is installed
+IMAGE_WIDTHS = [480, 960]
+IMAGE_CACHE_DIR = os.environ.get('PUBLISH_IMAGE_CACHE', os.path.expanduser(
+    '~/.cache/book-publish/images'
+))
+SEARCH_DIR = os.path.join(TARGET_DIR, 'search')
+SEARCH_WORD = re.compile(r'[a-z0-9_]+')
+SEARCH_STOPWORDS = sorted({
+    'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if', 'in',
+    'is', 'it', 'of', 'on', 'or', 'so', 'that', 'the', 'this', 'to', 'we',
+    'with', 'you',
+})
+
+
+def make_target(target):
+    result = subprocess.run(['make', target], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return target, result.returncode, result.stderr.decode()
 
 
 def make_chapters():
-    for chapter in CHAPTERS:
-        subprocess.check_call(['make', chapter], stdout=subprocess.PIPE)
+    failures = []
+    with ThreadPoolExecutor(MAKE_JOBS) as executor:
+        for target, returncode, errors in executor.map(make_target, CHAPTERS):
+            if returncode:
+                failures.append(target)
+                print(f'failed to make {target}:\n{errors}')
+    if failures:
+        raise SystemExit('failed to build: ' + ', '.join(failures))
 
 
-def parse_chapters():
-    for chapter in CHAPTERS:
-        raw_html = open(chapter).read()
-        yield chapter, html.fromstring(raw_html)
+def parse_chapter(chapter):
+    with open(chapter) as f:
+        return html.fromstring(f.read())
 
 
 def get_anchor_targets(parsed_html):
@@ -42,12 +98,15 @@ def get_anchor_targets(parsed_html):
     return [i for i in all_ids if not i.startswith('_') and i not in ignores]
 
 def get_chapter_info():
+    # only one chapter's tree is held at a time, so everything the later
+    # steps need from it is pulled out here
     chapter_info = {}
     appendix_numbers = list('ABCDEFGHIJKL')
     chapter_numbers = list(range(1, 100))
     part_numbers = list(range(1, 10))
 
-    for chapter, parsed_html in parse_chapters():
+    for chapter in CHAPTERS:
+        parsed_html = parse_chapter(chapter)
         print('getting info from', chapter)
 
         if not parsed_html.cssselect('h2'):
@@ -57,7 +116,7 @@ def get_chapter_info():
         href_id = header.get('id')
         if href_id is None:
             href_id = parsed_html.cssselect('body')[0].get('id')
-        subheaders = [h.get('id') for h in parsed_html.cssselect('h3')]
+        subheaders = [(h.get('id'), h.text_content()) for h in parsed_html.cssselect('h3')]
 
         chapter_title = header.text_content()
         chapter_title = chapter_title.replace('Appendix A: ', '')
@@ -79,92 +138,364 @@ def get_chapter_info():
 
 
         xrefs = get_anchor_targets(parsed_html)
-        chapter_info[chapter] = ChapterInfo(href_id, chapter_title, subheaders, xrefs)
+        links = [link.get('href')[1:] for link in parsed_html.cssselect('a[href^=\#]')]
+        images = [img.get('src') for img in parsed_html.cssselect('img')]
+        search_shard = build_search_shard(parsed_html, chapter_title)
+        chapter_info[chapter] = ChapterInfo(
+            href_id, chapter_title, subheaders, xrefs, links, images, search_shard
+        )
 
     return chapter_info
 
 
-def fix_xrefs(contents, chapter, chapter_info):
-    parsed = html.fromstring(contents)
-    links = parsed.cssselect('a[href^=\#]')
-    for link in links:
-        for other_chap in CHAPTERS:
-            if other_chap == chapter:
+def build_anchor_index(chapter_info):
+    anchor_index = {}
+    for chapter in CHAPTERS:
+        info = chapter_info[chapter]
+        anchors = list(info.xrefs)
+        if info.href_id and info.href_id not in anchors:
+            anchors.append(info.href_id)
+        for anchor in anchors:
+            if anchor in anchor_index:
+                print(f'WARNING: duplicate anchor #{anchor} in {anchor_index[anchor]} and {chapter}')
                 continue
-            chapter_id = chapter_info[other_chap].href_id
-            href = link.get('href')
-            targets = ['#' + x for x in chapter_info[other_chap].xrefs]
-            if href == '#' + chapter_id:
-                link.set('href', f'/book/{other_chap}')
-            elif href in targets:
-                link.set('href', f'/book/{other_chap}{href}')
+            anchor_index[anchor] = chapter
+    return anchor_index
+
 
-    return html.tostring(parsed)
+def fix_xrefs(parsed, chapter, chapter_info, anchor_index):
+    links = parsed.cssselect('a[href^=\#]')
+    for link in links:
+        anchor = link.get('href')[1:]
+        target_chapter = anchor_index.get(anchor)
+        if target_chapter is None:
+            if anchor and not parsed.xpath('//*[@id=$anchor]', anchor=anchor):
+                print(f'WARNING: dangling link to #{anchor} in {chapter}')
+            continue
+        if target_chapter == chapter:
+            continue
+        if anchor == chapter_info[target_chapter].href_id:
+            link.set('href', f'/book/{target_chapter}')
+        else:
+            link.set('href', f'/book/{target_chapter}#{anchor}')
 
 
-def fix_title(contents, chapter, chapter_info):
-    parsed = html.fromstring(contents)
+def fix_title(parsed, chapter, chapter_info):
     titles = parsed.cssselect('h2')
     if titles and titles[0].text.startswith('Appendix A'):
         title = titles[0]
         title.text = title.text.replace('Appendix A', chapter_info[chapter].chapter_title)
-    return html.tostring(parsed)
 
-def copy_chapters_across_with_fixes(chapter_info, fixed_toc):
+def png_size(data):
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and data[12:16] == b'IHDR':
+        return struct.unpack('>II', data[16:24])
+    return None, None
+
+
+@lru_cache(maxsize=None)
+def get_image_info(path):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    width, height = png_size(data)
+    if width is None and Image is not None:
+        with Image.open(path) as image:
+            width, height = image.size
+    return ImageInfo(hashlib.sha1(data).hexdigest(), width, height)
+
+
+def make_image_variant(path, info, width):
+    # the cache is keyed on the source contents, so renaming or moving an
+    # image doesn't mean resizing it again
+    cached = os.path.join(IMAGE_CACHE_DIR, f'{info.digest}-{width}.png')
+    if not os.path.exists(cached):
+        os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+        with Image.open(path) as image:
+            height = round(info.height * width / info.width)
+            has_alpha = image.mode in ('RGBA', 'LA') or 'transparency' in image.info
+            resized = image.convert('RGBA' if has_alpha else 'RGB').resize(
+                (width, height), Image.LANCZOS
+            )
+            # resampling smears screenshots into thousands of colours, a
+            # 256 colour palette gets most of that size back
+            resized = resized.quantize(
+                256, method=Image.Quantize.FASTOCTREE if has_alpha else Image.Quantize.MEDIANCUT
+            )
+            resized.save(cached + '.tmp', 'PNG', optimize=True)
+        os.replace(cached + '.tmp', cached)
+    return cached
+
+
+def publish_image_variants(src, info):
+    srcset = []
+    name, ext = os.path.splitext(src)
+    for width in IMAGE_WIDTHS:
+        if width >= info.width:
+            continue
+        variant = make_image_variant(src, info, width)
+        if os.path.getsize(variant) >= os.path.getsize(src):
+            continue
+        variant_src = f'{name}.{width}w.{info.digest[:10]}.png'
+        target = os.path.join(TARGET_DIR, variant_src)
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(variant, target)
+        srcset.append(f'{variant_src} {width}w')
+    return srcset
+
+
+def fix_images(parsed):
+    for img in parsed.cssselect('img'):
+        src = img.get('src')
+        info = get_image_info(src) if src else None
+        if info is None:
+            continue
+        img.set('loading', 'lazy')
+        img.set('decoding', 'async')
+        # an explicit size from the asciidoc wins, and we'd only get the aspect ratio wrong
+        if info.width is None or img.get('width') or img.get('height'):
+            continue
+        img.set('width', str(info.width))
+        img.set('height', str(info.height))
+        if Image is None:
+            continue
+        srcset = publish_image_variants(src, info)
+        if srcset:
+            img.set('srcset', ', '.join(srcset + [f'{src} {info.width}w']))
+            img.set('sizes', f'(max-width: {info.width}px) 100vw, {info.width}px')
+
+
+def hash_files(paths):
+    sha = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            sha.update(f.read())
+    return sha
+
+
+def chapter_inputs_hash(chapter, chapter_info, anchor_index, shared_hash):
+    sha = shared_hash.copy()
+    with open(chapter, 'rb') as f:
+        sha.update(f.read())
+    sha.update(chapter_info[chapter].chapter_title.encode('utf8'))
+    for anchor in chapter_info[chapter].links:
+        target_chapter = anchor_index.get(anchor)
+        target_id = target_chapter and chapter_info[target_chapter].href_id
+        sha.update(f'{anchor} {target_chapter} {target_id}\n'.encode('utf8'))
+    for src in chapter_info[chapter].images:
+        info = get_image_info(src or '')
+        sha.update(f'{src} {info and info.digest}\n'.encode('utf8'))
+    return sha.hexdigest()
+
+
+def load_manifest():
+    try:
+        with open(MANIFEST_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_atomically(path, contents):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb' if isinstance(contents, bytes) else 'w') as f:
+        f.write(contents)
+    os.replace(temp_path, path)
+
+
+def write_output(path, contents):
+    # precompressed siblings for the web server to pick up, mtime=0 keeps
+    # the .gz files identical between runs
+    if isinstance(contents, str):
+        contents = contents.encode('utf8')
+    write_atomically(path, contents)
+    write_atomically(path + '.gz', gzip.compress(contents, 9, mtime=0))
+    if brotli is not None:
+        write_atomically(path + '.br', brotli.compress(contents))
+
+
+def is_published(path):
+    if not os.path.exists(path) or not os.path.exists(path + '.gz'):
+        return False
+    return brotli is None or os.path.exists(path + '.br')
+
+
+def fingerprinted_name(path):
+    with open(path, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()[:10]
+    name, ext = os.path.splitext(os.path.basename(path))
+    return f'{name}.{digest}{ext}'
+
+
+def publish_static_assets():
+    # old fingerprinted files are left in place for pages still cached elsewhere
+    asset_names = {}
+    for asset in STATIC_ASSETS:
+        asset_names[asset] = fingerprinted_name(asset)
+        target = os.path.join(TARGET_DIR, asset_names[asset])
+        if not is_published(target):
+            print('publishing', asset_names[asset])
+            with open(asset, 'rb') as f:
+                write_output(target, f.read())
+    return asset_names
+
+
+def fix_stylesheet_links(parsed, asset_names):
+    for link in parsed.cssselect('link[rel=stylesheet]'):
+        href = link.get('href')
+        directory, name = os.path.split(href)
+        if name in asset_names:
+            link.set('href', os.path.join(directory, asset_names[name]))
+
+
+def copy_chapters_across_with_fixes(chapter_info, asset_names):
     comments_html = open('disqus_comments.html').read()
+    # lxml moves an element when it's appended somewhere else, so each
+    # chapter gets its own deepcopy of these
     buy_book_div = html.fromstring(open('buy_the_book_banner.html').read())
     analytics_div = html.fromstring(open('analytics.html').read())
-    load_toc_script = open('load_toc.js').read()
+    load_toc_script = html.fragment_fromstring(
+        f'<script src="{asset_names["load_toc.js"]}" defer></script>'
+    )
+    search_script = html.fragment_fromstring(
+        f'<script src="{asset_names["search.js"]}" defer></script>'
+    )
+    anchor_index = build_anchor_index(chapter_info)
+    shared_hash = hash_files(SHARED_INPUTS)
+    # installing Pillow adds srcsets, so it has to invalidate every chapter
+    shared_hash.update(repr(IMAGE_WIDTHS if Image is not None else []).encode('utf8'))
+    manifest = load_manifest()
+    new_manifest = {}
 
     for chapter in CHAPTERS:
-        old_contents = open(chapter).read()
-        new_contents = fix_xrefs(old_contents, chapter, chapter_info)
-        new_contents = fix_title(new_contents, chapter, chapter_info)
-        parsed = html.fromstring(new_contents)
+        inputs_hash = chapter_inputs_hash(chapter, chapter_info, anchor_index, shared_hash)
+        new_manifest[chapter] = inputs_hash
+        target = os.path.join(TARGET_DIR, chapter)
+        if manifest.get(chapter) == inputs_hash and is_published(target):
+            continue
+        print('publishing', chapter)
+
+        # parsed again, but only for the chapters that changed
+        parsed = parse_chapter(chapter)
+        fix_xrefs(parsed, chapter, chapter_info, anchor_index)
+        fix_title(parsed, chapter, chapter_info)
+        fix_stylesheet_links(parsed, asset_names)
+        fix_images(parsed)
         body = parsed.cssselect('body')[0]
         if parsed.cssselect('#header'):
             head = parsed.cssselect('head')[0]
-            head.append(html.fragment_fromstring('<script>' + load_toc_script + '</script>'))
+            head.append(deepcopy(load_toc_script))
+            head.append(deepcopy(search_script))
             body.set('class', 'article toc2 toc-left')
-        body.insert(0, buy_book_div)
+        body.insert(0, deepcopy(buy_book_div))
         body.append(html.fromstring(
             comments_html.replace('CHAPTER_NAME', chapter.split('.')[0])
         ))
-        body.append(analytics_div)
-        fixed_contents = html.tostring(parsed)
+        body.append(deepcopy(analytics_div))
+        write_output(target, html.tostring(parsed))
 
-        target = os.path.join('/home/harry/workspace/www.obeythetestinggoat.com/content/book', chapter)
-        with open(target, 'w') as f:
-            f.write(fixed_contents.decode('utf8'))
-        toc = '/home/harry/workspace/www.obeythetestinggoat.com/content/book/toc.html'
-        with open(toc, 'w') as f:
-            f.write(html.tostring(fixed_toc).decode('utf8'))
+    write_atomically(MANIFEST_PATH, json.dumps(new_manifest, indent=2, sort_keys=True))
 
 
-def extract_toc_from_book():
-    subprocess.check_call(['make', 'book.html'], stdout=subprocess.PIPE)
-    parsed = html.fromstring(open('book.html').read())
-    return parsed.cssselect('#toc')[0]
+def write_output_if_changed(path, contents):
+    if is_published(path) and open(path).read() == contents:
+        return
+    write_output(path, contents)
 
 
+def write_toc(toc):
+    write_output_if_changed(os.path.join(TARGET_DIR, 'toc.html'), html.tostring(toc).decode('utf8'))
 
-def fix_toc(toc, chapter_info):
-    href_mappings = {}
+
+def tokenize(text):
+    return [
+        word for word in SEARCH_WORD.findall(text.lower())
+        if len(word) > 1 and word not in SEARCH_STOPWORDS
+    ]
+
+
+def get_sections(parsed, chapter_title):
+    # [anchor, title, words], the text before the first subheader counts
+    # as the chapter itself
+    sections = [[None, chapter_title, []]]
+    for element in parsed.cssselect('body')[0].iter():
+        if isinstance(element.tag, str) and element.tag not in ('script', 'style'):
+            if element.tag in ('h3', 'h4') and element.get('id'):
+                sections.append([element.get('id'), element.text_content().strip(), []])
+            sections[-1][2].extend(tokenize(element.text or ''))
+        sections[-1][2].extend(tokenize(element.tail or ''))
+    return sections
+
+
+def build_search_shard(parsed, chapter_title):
+    sections = get_sections(parsed, chapter_title)
+    terms = {}
+    for section_number, (_, _, words) in enumerate(sections):
+        for word, count in Counter(words).items():
+            terms.setdefault(word, []).extend([section_number, count])
+    return {
+        'sections': [[anchor, title] for anchor, title, _ in sections],
+        'terms': terms,
+    }
+
+
+def write_search_index(chapter_info):
+    # one small manifest saying which chapters have which terms, then a
+    # shard per chapter with the per-section counts, which search.js only
+    # fetches for the chapters a query could match
+    os.makedirs(SEARCH_DIR, exist_ok=True)
+    manifest = {'chapters': [], 'terms': {}, 'stopwords': SEARCH_STOPWORDS}
+    for chapter_number, chapter in enumerate(CHAPTERS):
+        shard = chapter_info[chapter].search_shard
+        contents = json.dumps(shard, separators=(',', ':'), sort_keys=True)
+        shard_name = os.path.splitext(chapter)[0]
+        write_output_if_changed(os.path.join(SEARCH_DIR, shard_name + '.json'), contents)
+        manifest['chapters'].append([
+            chapter,
+            chapter_info[chapter].chapter_title,
+            hashlib.sha1(contents.encode('utf8')).hexdigest()[:10],
+            shard_name,
+        ])
+        for term in shard['terms']:
+            manifest['terms'].setdefault(term, []).append(chapter_number)
+    write_output_if_changed(
+        os.path.join(SEARCH_DIR, 'index.json'),
+        json.dumps(manifest, separators=(',', ':'), sort_keys=True),
+    )
+
+
+def build_toc(chapter_info):
+    # same shape as the asciidoctor toc we used to cut out of book.html:
+    # parts and the front and back matter in sectlevel0, each part's
+    # chapters nested under it.  load_toc.js relies on the sectlevel2 lists
+    toc = html.fragment_fromstring(
+        '<div id="toc" class="toc2"><div id="toctitle">Table of Contents</div></div>'
+    )
+    top_list = etree.SubElement(toc, 'ul', {'class': 'sectlevel0'})
+    part_item = None
+    part_chapters_list = None
     for chapter in CHAPTERS:
         chap = chapter_info[chapter]
-        if chap.href_id:
-            href_mappings['#' + chap.href_id] = f'/book/{chapter}'
-        for subheader in chap.subheaders:
-            href_mappings['#' + subheader] = f'/book/{chapter}#{subheader}'
-
-    def fix_link(href):
-        if href in href_mappings:
-            return href_mappings[href]
+        if chapter.startswith('chapter_') and part_item is not None:
+            if part_chapters_list is None:
+                part_chapters_list = etree.SubElement(part_item, 'ul', {'class': 'sectlevel1'})
+            item = etree.SubElement(part_chapters_list, 'li')
         else:
-            return href
-
-    toc.rewrite_links(fix_link)
-    toc.set('class', 'toc2')
+            # the epilogue and appendices come after the last part, not in it
+            item = etree.SubElement(top_list, 'li')
+            part_item = item if chapter.startswith('part') else None
+            part_chapters_list = None
+        link = etree.SubElement(item, 'a', href=f'/book/{chapter}')
+        link.text = chap.chapter_title
+        subheaders = [(id, title) for id, title in chap.subheaders if id]
+        if subheaders:
+            subheaders_list = etree.SubElement(item, 'ul', {'class': 'sectlevel2'})
+            for subheader, title in subheaders:
+                sub_item = etree.SubElement(subheaders_list, 'li')
+                sub_link = etree.SubElement(sub_item, 'a', href=f'/book/{chapter}#{subheader}')
+                sub_link.text = title
     return toc
 
 
@@ -176,10 +507,11 @@ def print_toc_md(chapter_info):
 
 def main():
     make_chapters()
-    toc = extract_toc_from_book()
     chapter_info = get_chapter_info()
-    fixed_toc = fix_toc(toc, chapter_info)
-    copy_chapters_across_with_fixes(chapter_info, fixed_toc)
+    asset_names = publish_static_assets()
+    write_search_index(chapter_info)
+    copy_chapters_across_with_fixes(chapter_info, asset_names)
+    write_toc(build_toc(chapter_info))
     print_toc_md(chapter_info)
 
 
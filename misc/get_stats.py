@@ -13,7 +13,7 @@ BOOK_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 
 def get_log():
     commits = []
-    log = subprocess.check_output(['git', 'log', '--format=%h|%s|%ai']).decode('utf8')
+    log = subprocess.check_output(['git', 'log', '--format=%h|%s|%ai'], cwd=BOOK_ROOT).decode('utf8')
     for line in log.split('\n'):
         if line:
             hash, subject, datestring = line.split('|')
@@ -22,18 +22,56 @@ def get_log():
     return commits
 
 
-def checkout_commit(hash):
-    subprocess.check_call(['git', 'checkout', hash])
+class BlobReader(object):
+    # one long-running cat-file instead of a process (or a checkout) per file
 
+    def __init__(self):
+        self.process = subprocess.Popen(
+            ['git', 'cat-file', '--batch'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=BOOK_ROOT,
+        )
 
-def get_wordcounts():
-    docs = [f for f in os.listdir(BOOK_ROOT) if f.endswith('.asciidoc')]
+    def read_object(self, name):
+        self.process.stdin.write(name.encode('ascii') + b'\n')
+        self.process.stdin.flush()
+        header = self.process.stdout.readline().split()
+        if len(header) != 3:
+            raise ValueError('could not read object {}: {}'.format(name, b' '.join(header)))
+        contents = self.process.stdout.read(int(header[2]))
+        self.process.stdout.read(1)  # trailing newline
+        return contents
+
+    def read(self, sha):
+        return self.read_object(sha).decode('utf8', errors='replace')
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+def get_docs(hash, blob_reader):
+    # raw tree objects are "<mode> <name>\0<20-byte sha>" back to back
+    tree = blob_reader.read_object(hash + '^{tree}')
+    pos = 0
+    while pos < len(tree):
+        space = tree.index(b' ', pos)
+        nul = tree.index(b'\0', space)
+        mode = tree[pos:space]
+        filename = tree[space + 1:nul].decode('utf8')
+        sha = tree[nul + 1:nul + 21].hex()
+        pos = nul + 21
+        if mode not in (b'40000', b'160000') and filename.endswith('.asciidoc'):
+            yield filename, sha
+
+
+def get_wordcounts(hash, blob_reader, counts_by_blob):
     wordcounts = []
-    for filename in docs:
-        with open(os.path.join(BOOK_ROOT, filename)) as f:
-            contents = f.read()
-        lines = len(contents.split('\n'))
-        words = len(contents.split())
+    for filename, sha in get_docs(hash, blob_reader):
+        # most files don't change from one commit to the next
+        if sha not in counts_by_blob:
+            contents = blob_reader.read(sha)
+            counts_by_blob[sha] = len(contents.split('\n')), len(contents.split())
+        lines, words = counts_by_blob[sha]
         filename = re.sub(r'_(\d)\.asciidoc', r'_0\1.asciidoc', filename)
         filename = re.sub(r'chapter(\d\d)\.asciidoc', r'chapter_\1.asciidoc', filename)
         wordcounts.append(WordCount(filename, lines=lines, words=words))
@@ -44,10 +82,11 @@ def main():
     commits = get_log()
     all_wordcounts = {}
     filenames = set()
+    counts_by_blob = {}
+    blob_reader = BlobReader()
     try:
         for commit in commits:
-            checkout_commit(commit.hash)
-            all_wordcounts[commit] = get_wordcounts()
+            all_wordcounts[commit] = get_wordcounts(commit.hash, blob_reader, counts_by_blob)
             filenames.update(set(wc.filename for wc in all_wordcounts[commit]))
 
         with open(os.path.join(BOOK_ROOT, 'wordcounts.tsv'), 'w') as csvfile:
@@ -72,7 +111,7 @@ def main():
                 writer.writerow(row)
 
     finally:
-        checkout_commit('master')
+        blob_reader.close()
 
 
 
@@ -1,3 +1,16 @@
 export PYTHONHASHSEED=0
-py.test -s tests/test_chapter*.py
+if [ -n "$BASE_REF" ]; then
+    if CHAPTER_TESTS=$(python3 tests/affected_chapters.py "$BASE_REF"); then
+        if [ -z "$CHAPTER_TESTS" ]; then
+            echo "no chapters affected by changes since $BASE_REF"
+            exit 0
+        fi
+    else
+        echo "couldn't work out the chapters affected since $BASE_REF, running them all"
+        CHAPTER_TESTS=tests/test_chapter*.py
+    fi
+else
+    CHAPTER_TESTS=tests/test_chapter*.py
+fi
+py.test -s $CHAPTER_TESTS
 export PYTHONHASHSEED=
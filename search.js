@@ -0,0 +1,185 @@
+var bookSearch = (function() {
+  var manifest = null;
+  var manifestCallbacks = [];
+  var shards = {};
+  var MAX_RESULTS = 20;
+  var MAX_PREFIX_TERMS = 30;
+
+  function getJSON(url, callback) {
+    var request = new XMLHttpRequest();
+    request.onreadystatechange = function() {
+      if (request.readyState === XMLHttpRequest.DONE && request.status === 200) {
+        callback(JSON.parse(request.responseText));
+      }
+    };
+    request.open('GET', url);
+    request.send();
+  }
+
+  function loadManifest(callback) {
+    if (manifest) {
+      return callback(manifest);
+    }
+    manifestCallbacks.push(callback);
+    if (manifestCallbacks.length === 1) {
+      getJSON('search/index.json', function(data) {
+        manifest = data;
+        manifest.termList = Object.keys(data.terms).sort();
+        manifestCallbacks.forEach(function(cb) { cb(manifest); });
+        manifestCallbacks = [];
+      });
+    }
+  }
+
+  function loadShard(chapterIndex, callback) {
+    var chapter = manifest.chapters[chapterIndex];
+    if (shards[chapterIndex]) {
+      return callback(shards[chapterIndex]);
+    }
+    getJSON('search/' + chapter[3] + '.json?' + chapter[2], function(data) {
+      shards[chapterIndex] = data;
+      callback(data);
+    });
+  }
+
+  function tokenize(query) {
+    return (query.toLowerCase().match(/[a-z0-9_]+/g) || []).filter(function(word) {
+      return word.length > 1 && manifest.stopwords.indexOf(word) === -1;
+    });
+  }
+
+  function expandPrefix(prefix) {
+    // binary search for the first term >= prefix, then walk forwards
+    var terms = manifest.termList;
+    var lo = 0, hi = terms.length;
+    while (lo < hi) {
+      var mid = (lo + hi) >> 1;
+      if (terms[mid] < prefix) { lo = mid + 1; } else { hi = mid; }
+    }
+    var expanded = [];
+    while (lo < terms.length && terms[lo].indexOf(prefix) === 0 && expanded.length < MAX_PREFIX_TERMS) {
+      expanded.push(terms[lo++]);
+    }
+    return expanded;
+  }
+
+  function chaptersFor(alternatives) {
+    var chapters = {};
+    alternatives.forEach(function(term) {
+      manifest.terms[term].forEach(function(i) { chapters[i] = true; });
+    });
+    return chapters;
+  }
+
+  function search(query, callback) {
+    loadManifest(function() {
+      var words = tokenize(query);
+      if (!words.length) {
+        return callback([]);
+      }
+      // every word has to match exactly, apart from the last one which
+      // the reader may still be typing
+      var queryTerms = words.map(function(word, i) {
+        if (i === words.length - 1) {
+          return expandPrefix(word);
+        }
+        return manifest.terms[word] ? [word] : [];
+      });
+      var candidates = null;
+      queryTerms.forEach(function(alternatives) {
+        var chapters = chaptersFor(alternatives);
+        if (candidates === null) {
+          candidates = chapters;
+        } else {
+          Object.keys(candidates).forEach(function(i) {
+            if (!chapters[i]) { delete candidates[i]; }
+          });
+        }
+      });
+      var chapterIndexes = Object.keys(candidates);
+      var results = [];
+      var pending = chapterIndexes.length;
+      if (!pending) {
+        return callback([]);
+      }
+      chapterIndexes.forEach(function(chapterIndex) {
+        loadShard(chapterIndex, function(shard) {
+          results = results.concat(scoreSections(chapterIndex, shard, queryTerms));
+          if (--pending === 0) {
+            results.sort(function(a, b) { return b.score - a.score; });
+            callback(results.slice(0, MAX_RESULTS));
+          }
+        });
+      });
+    });
+  }
+
+  function scoreSections(chapterIndex, shard, queryTerms) {
+    var chapter = manifest.chapters[chapterIndex];
+    var scores = shard.sections.map(function() { return 0; });
+    var matched = shard.sections.map(function() { return 0; });
+    queryTerms.forEach(function(alternatives, termNumber) {
+      alternatives.forEach(function(term) {
+        var postings = shard.terms[term] || [];
+        for (var i = 0; i < postings.length; i += 2) {
+          scores[postings[i]] += postings[i + 1];
+          matched[postings[i]] |= 1 << termNumber;
+        }
+      });
+    });
+    var allMatched = (1 << queryTerms.length) - 1;
+    var results = [];
+    shard.sections.forEach(function(section, i) {
+      if (matched[i] === allMatched) {
+        results.push({
+          href: '/book/' + chapter[0] + (section[0] ? '#' + section[0] : ''),
+          title: section[0] ? chapter[1] + ' › ' + section[1] : chapter[1],
+          score: scores[i]
+        });
+      }
+    });
+    return results;
+  }
+
+  function showResults(results) {
+    var list = document.getElementById('book-search-results');
+    list.innerHTML = '';
+    results.forEach(function(result) {
+      var item = document.createElement('li');
+      var link = document.createElement('a');
+      link.href = result.href;
+      link.textContent = result.title;
+      item.appendChild(link);
+      list.appendChild(item);
+    });
+  }
+
+  var timer = null;
+  // listen on the document, load_toc.js rewrites #header's innerHTML
+  // which would drop any listener attached to the input itself
+  document.addEventListener('input', function(event) {
+    if (event.target.id !== 'book-search-input') {
+      return;
+    }
+    var query = event.target.value;
+    clearTimeout(timer);
+    timer = setTimeout(function() {
+      search(query, function(results) {
+        if (document.getElementById('book-search-input').value === query) {
+          showResults(results);
+        }
+      });
+    }, 150);
+  });
+
+  var header = document.getElementById('header');
+  if (header) {
+    var box = document.createElement('div');
+    box.id = 'book-search';
+    box.innerHTML = '<input id="book-search-input" type="search" placeholder="Search the book">' +
+      '<ol id="book-search-results"></ol>';
+    header.insertBefore(box, header.firstChild);
+  }
+
+  return search;
+})();
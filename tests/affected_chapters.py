@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Print the chapter test files affected by changes since a git ref.
+
+Usage:
+    affected_chapters.py [<base_ref>]
+
+Compares the working tree (including untracked files) against <base_ref>
+(default: origin/master) and maps changed asciidoc files, source submodules,
+chapter tests and harness modules to the chapter tests that depend on them.
+"""
+import fnmatch
+import json
+import os
+import re
+import subprocess
+
+from docopt import docopt
+
+BASE_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# files in tests/ that no chapter run depends on
+NOT_HARNESS = {
+    'tests/benchmarks.py',
+    'tests/benchmark_baseline.json',
+    'tests/check_links.py',
+    'tests/examples.py',
+    'tests/affected_chapters.py',
+}
+# the full run in run_all_tests.sh, which nothing selected here should go beyond
+CHAPTER_TESTS_GLOB = 'test_chapter*.py'
+# top-level files every chapter run depends on
+GLOBAL_DEPENDENCIES = {'Makefile', 'run_all_tests.sh', 'requirements.txt', '.gitmodules'}
+
+
+def get_changed_files(base_ref):
+    diff = subprocess.check_output(
+        ['git', 'diff', '--name-only', base_ref], cwd=BASE_FOLDER
+    ).decode()
+    untracked = subprocess.check_output(
+        ['git', 'ls-files', '--others', '--exclude-standard'], cwd=BASE_FOLDER
+    ).decode()
+    return sorted(set(diff.split()) | set(untracked.split()))
+
+
+def get_chapter_tests():
+    chapter_tests = {}
+    for filename in sorted(os.listdir(os.path.join(BASE_FOLDER, 'tests'))):
+        if not fnmatch.fnmatch(filename, CHAPTER_TESTS_GLOB):
+            continue
+        with open(os.path.join(BASE_FOLDER, 'tests', filename)) as f:
+            match = re.search(r"^\s+chapter_name = '(.+)'$", f.read(), re.MULTILINE)
+        if match:
+            chapter_tests[match.group(1)] = 'tests/' + filename
+    return chapter_tests
+
+
+def get_book_chapters():
+    with open(os.path.join(BASE_FOLDER, 'atlas.json')) as f:
+        files = json.load(f)['files']
+    return [f.replace('.asciidoc', '') for f in files if f.endswith('.asciidoc')]
+
+
+def is_harness_file(path):
+    if path in GLOBAL_DEPENDENCIES:
+        return True
+    return (
+        path.startswith('tests/') and
+        path not in NOT_HARNESS and
+        not os.path.basename(path).startswith('test_')
+    )
+
+
+def get_affected_tests(changed_files, chapter_tests, book_chapters):
+    affected = set()
+    test_files = set(chapter_tests.values())
+    for path in changed_files:
+        if is_harness_file(path):
+            return sorted(test_files)
+        if path in test_files:
+            affected.add(path)
+            continue
+        asciidoc_match = re.match(r'^([^/]+)\.asciidoc$', path)
+        if asciidoc_match and asciidoc_match.group(1) in book_chapters:
+            chapter = asciidoc_match.group(1)
+        else:
+            submodule_match = re.match(r'^source/([^/]+)/superlists(/|$)', path)
+            if not submodule_match:
+                continue
+            chapter = submodule_match.group(1)
+        if chapter in chapter_tests:
+            affected.add(chapter_tests[chapter])
+    return sorted(affected)
+
+
+def main():
+    args = docopt(__doc__)
+    base_ref = args['<base_ref>'] or 'origin/master'
+    affected = get_affected_tests(
+        get_changed_files(base_ref), get_chapter_tests(), get_book_chapters()
+    )
+    print('\n'.join(affected))
+
+
+if __name__ == '__main__':
+    main()
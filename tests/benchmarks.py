@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks for the book tester's hot paths.
+
+Usage:
+    benchmarks.py [--max-scale=<n>] [--save]
+    benchmarks.py --compare [--max-scale=<n>] [--threshold=<ratio>]
+
+Options:
+    --max-scale=<n>      Largest input scale to run (1, 10, 100 or 1000) [default: 1000]
+    --save               Overwrite the baseline file with these results
+    --compare            Compare against the baseline and exit 1 on regressions
+    --threshold=<ratio>  Slowdown ratio counted as a regression [default: 1.5]
+"""
+import contextlib
+import io
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+from docopt import docopt
+from lxml import html
+
+import examples
+from book_parser import CodeListing, Output, parse_listing
+from book_tester import standardise_outputs
+from source_updater import Source
+from sourcetree import Commit, check_listing_matches_commit
+from write_to_file import _write_to_file
+
+SCALES = [1, 10, 100, 1000]
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+MANAGE_PY_OUTPUT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'actual_manage_py_test.output')
+MIN_TIME = 0.2
+MAX_REPEATS = 50
+# skip a scale if quadratic growth from the previous one would take longer than this
+MAX_ESTIMATED_TIME = 10
+
+
+def scale_listing_html(listing_html, scale):
+    def repeat_contents(match):
+        return match.group(1) + '\n'.join([match.group(2)] * scale) + match.group(3)
+    return re.sub(
+        r'(<pre[^>]*>(?:<code[^>]*>)?)(.*?)((?:</code>)?</pre>)',
+        repeat_contents, listing_html, flags=re.DOTALL,
+    )
+
+
+def example_listings():
+    return [
+        getattr(examples, name) for name in sorted(dir(examples))
+        if name.isupper() and '<pre' in getattr(examples, name)
+    ]
+
+
+def synthetic_diff(scale):
+    lines = ['diff --git a/foo.py b/foo.py', '@@ -1,10 +1,10 @@']
+    for i in range(10 * scale):
+        if i % 5 == 0:
+            lines.append('-    old_line_{}()'.format(i))
+            lines.append('+    new_line_{}()'.format(i))
+        else:
+            lines.append('     context_line_{}()'.format(i))
+    return '\n'.join(lines)
+
+
+def synthetic_future_contents(scale):
+    return '\n'.join(
+        '    new_line_{}()'.format(i) if i % 5 == 0 else '    context_line_{}()'.format(i)
+        for i in range(10 * scale)
+    )
+
+
+def synthetic_module(scale):
+    return '\n\n\n'.join(
+        'def function_{0}(request):\n    return {0}'.format(i) for i in range(10 * scale)
+    ) + '\n'
+
+
+def synthetic_imports(scale):
+    return '\n'.join(
+        ['from lists.models import Item', 'from django.shortcuts import render'] +
+        ['import module_{}'.format(i) for i in range(10 * scale)] +
+        ['', '', 'def view(request):', '    pass']
+    )
+
+
+def bench_parse_listing(scale):
+    nodes = [html.fromstring(scale_listing_html(l, scale)) for l in example_listings()]
+    def run():
+        for node in nodes:
+            parse_listing(node)
+    return run
+
+
+def bench_output_normalizer(scale):
+    with open(MANAGE_PY_OUTPUT_PATH) as f:
+        base = '\n'.join(f.read().split('\n')[:50])
+    actual = '\n'.join([base] * scale)
+    expected = Output(actual)
+    def run():
+        standardise_outputs(actual, expected)
+    return run
+
+
+def bench_commit_from_diff(scale):
+    diff = synthetic_diff(scale)
+    def run():
+        Commit.from_diff(diff)
+    return run
+
+
+def bench_check_listing_matches_commit(scale):
+    commit = Commit.from_diff(synthetic_diff(scale))
+    future_contents = synthetic_future_contents(scale)
+    listing = CodeListing(filename='foo.py', contents=future_contents)
+    def run():
+        check_listing_matches_commit(listing, commit, future_contents)
+    return run
+
+
+def bench_write_to_file(scale):
+    tempdir = tempfile.mkdtemp()
+    path = os.path.join(tempdir, 'views.py')
+    old_contents = synthetic_module(scale)
+    new_contents = 'def function_1(request):\n    return "changed"'
+    def run():
+        with open(path, 'w') as f:
+            f.write(old_contents)
+        _write_to_file(path, new_contents)
+    run.cleanup = lambda: shutil.rmtree(tempdir)
+    return run
+
+
+def bench_source_import_fixing(scale):
+    contents = synthetic_imports(scale)
+    def run():
+        source = Source._from_contents(contents)
+        source.add_imports(['import os'])
+        source.get_updated_contents()
+    return run
+
+
+BENCHMARKS = [
+    ('parse_listing', bench_parse_listing),
+    ('output_normalizer', bench_output_normalizer),
+    ('Commit.from_diff', bench_commit_from_diff),
+    ('check_listing_matches_commit', bench_check_listing_matches_commit),
+    ('write_to_file', bench_write_to_file),
+    ('source_import_fixing', bench_source_import_fixing),
+]
+
+
+def time_function(run):
+    timings = []
+    start = time.perf_counter()
+    while len(timings) < MAX_REPEATS and (not timings or time.perf_counter() - start < MIN_TIME):
+        call_start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - call_start)
+    return min(timings)
+
+
+def run_benchmarks(scales):
+    results = {}
+    for name, make_benchmark in BENCHMARKS:
+        results[name] = {}
+        previous = None
+        for scale in scales:
+            if previous and previous[1] * (scale / previous[0]) ** 2 > MAX_ESTIMATED_TIME:
+                print('{:<30} {:>5}x {:>13}'.format(name, scale, 'skipped'))
+                continue
+            run = make_benchmark(scale)
+            with contextlib.redirect_stdout(io.StringIO()):
+                results[name][str(scale)] = time_function(run)
+            if hasattr(run, 'cleanup'):
+                run.cleanup()
+            previous = (scale, results[name][str(scale)])
+            print('{:<30} {:>5}x {:>12.6f}s'.format(name, scale, previous[1]))
+    return results
+
+
+def find_regressions(baseline, results, threshold):
+    regressions = []
+    for name, timings in sorted(results.items()):
+        for scale, seconds in sorted(timings.items(), key=lambda t: int(t[0])):
+            baseline_seconds = baseline.get(name, {}).get(scale)
+            if baseline_seconds and seconds > baseline_seconds * threshold:
+                regressions.append((name, scale, baseline_seconds, seconds))
+    return regressions
+
+
+def main():
+    args = docopt(__doc__)
+    scales = [s for s in SCALES if s <= int(args['--max-scale'])]
+    results = run_benchmarks(scales)
+
+    if args['--save']:
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('saved baseline to', BASELINE_PATH)
+
+    if args['--compare']:
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(baseline, results, float(args['--threshold']))
+        for name, scale, before, after in regressions:
+            print('REGRESSION {} at {}x: {:.6f}s -> {:.6f}s ({:.1f}x slower)'.format(
+                name, scale, before, after, after / before
+            ))
+        if regressions:
+            sys.exit(1)
+        print('no regressions against', BASELINE_PATH)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import gzip
+import logging
+import os
+import sys
+
+LOG_DIR = os.environ.get('BOOK_TESTER_LOG_DIR', os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..', 'logs'
+)))
+# quiet mode only shows progress on the console, everything still goes to the log file
+QUIET = os.environ.get('BOOK_TESTER_QUIET', '') not in ('', '0')
+# longer messages (pip installs, tracebacks, whole files) get cut short on the console
+MAX_CONSOLE_CHARS = int(os.environ.get('BOOK_TESTER_MAX_CONSOLE_CHARS', 20000))
+
+logger = logging.getLogger('book_tester')
+logger.setLevel(logging.DEBUG)
+logger.propagate = False
+
+
+def get_logger(name):
+    return logger.getChild(name)
+
+
+
+class ConsoleHandler(logging.Handler):
+
+    def __init__(self, level):
+        super().__init__(level)
+        self.log_path = None
+
+
+    def format(self, record):
+        message = super().format(record)
+        if len(message) > MAX_CONSOLE_CHARS:
+            message = '{}\n[... {} more chars, see {}]'.format(
+                message[:MAX_CONSOLE_CHARS],
+                len(message) - MAX_CONSOLE_CHARS,
+                self.log_path or 'the chapter log',
+            )
+        return message
+
+
+    def emit(self, record):
+        # looked up each time so test runners that swap stdout still see us
+        try:
+            sys.stdout.write(self.format(record) + '\n')
+        except BlockingIOError:
+            pass  # a slow terminal shouldn't hold up the run
+        except Exception:
+            self.handleError(record)
+
+
+
+CONSOLE = ConsoleHandler(logging.INFO if QUIET else logging.DEBUG)
+logger.addHandler(CONSOLE)
+
+
+def start_chapter_log(chapter_name, log_dir=None):
+    log_dir = log_dir or LOG_DIR
+    os.makedirs(log_dir, exist_ok=True)
+    path = os.path.join(log_dir, '{}.log.gz'.format(chapter_name))
+    # gzip buffers and compresses as we go, and finishes the file on close
+    handler = logging.StreamHandler(gzip.open(path, 'wt', encoding='utf8'))
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    handler.path = path
+    logger.addHandler(handler)
+    CONSOLE.log_path = path
+    return handler
+
+
+def stop_chapter_log(handler):
+    logger.removeHandler(handler)
+    handler.close()
+    handler.stream.close()
+    if CONSOLE.log_path == handler.path:
+        CONSOLE.log_path = None
+    return handler.path
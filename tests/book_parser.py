@@ -23,6 +23,7 @@ class CodeListing(object):
         self.contents = contents
         self.was_written = False
         self.skip = False
+        self.dofirst = None
         self.currentcontents = False
 
 
@@ -0,0 +1,154 @@
+import base64
+import hashlib
+import json
+import os
+import re
+
+CASSETTE_MODE = os.environ.get('BOOK_CASSETTE')  # 'record' or 'replay'
+CASSETTE_DIR = os.environ.get('CASSETTE_DIR', os.path.abspath(os.path.join(
+    os.path.dirname(__file__), 'cassettes'
+)))
+TEMPDIR_PLACEHOLDER = '{TEMPDIR}'
+IGNORED_DIRS = {'.git', '__pycache__'}
+# these only move files and git objects around, cheap and deterministic, so
+# they really run on replay and the tree gets built on disk.  anything else
+# (tests, FTs, runserver, pip, manage.py...) is replayed, along with the
+# files it changed
+REAL_ON_REPLAY = {
+    'git', 'patch', 'mkdir', 'cp', 'mv', 'rm', 'touch', 'ls', 'tree', 'cat',
+    'echo', 'sed', 'find', 'diff', 'head', 'tail', 'wc', 'grep', 'cd',
+}
+
+
+class CassetteMiss(Exception):
+    pass
+
+
+def runs_on_replay(command):
+    # every step of a pipeline or && chain has to be cheap
+    for step in re.split(r'&&|\|\||\||;', command):
+        words = step.split()
+        if words and words[0] not in REAL_ON_REPLAY:
+            return False
+    return True
+
+
+def _tree_files(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d not in IGNORED_DIRS)
+        for filename in sorted(filenames):
+            if not filename.endswith('.pyc'):
+                yield os.path.join(dirpath, filename)
+
+
+def tree_snapshot(root):
+    snapshot = {}
+    for path in _tree_files(root):
+        try:
+            with open(path, 'rb') as f:
+                snapshot[os.path.relpath(path, root)] = hashlib.sha1(f.read()).hexdigest()
+        except OSError:
+            pass
+    return snapshot
+
+
+def tree_changes(root, before):
+    # {relative path: base64 contents, or None if it was deleted}
+    after = tree_snapshot(root)
+    changes = {path: None for path in before if path not in after}
+    for path, digest in after.items():
+        if before.get(path) != digest:
+            with open(os.path.join(root, path), 'rb') as f:
+                changes[path] = base64.b64encode(f.read()).decode('ascii')
+    return changes
+
+
+def apply_tree_changes(root, changes):
+    for path, contents in changes.items():
+        full_path = os.path.join(root, path)
+        if contents is None:
+            if os.path.exists(full_path):
+                os.remove(full_path)
+            continue
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'wb') as f:
+            f.write(base64.b64decode(contents))
+
+
+def snapshot_hash(snapshot):
+    sha = hashlib.sha1()
+    for path, digest in sorted(snapshot.items()):
+        sha.update(path.encode('utf8') + b'\0' + digest.encode('ascii') + b'\0')
+    return sha.hexdigest()
+
+
+def tree_hash(root):
+    return snapshot_hash(tree_snapshot(root))
+
+
+class Cassette(object):
+
+    def __init__(self, path, mode, tempdir):
+        self.path = path
+        self.mode = mode
+        self.tempdir = tempdir
+        self.entries = []
+        self.hash_mismatches = 0
+        if mode == 'replay':
+            with open(path) as f:
+                self.entries = json.load(f)['entries']
+        self._unplayed = list(self.entries)
+
+
+    @classmethod
+    def for_chapter(kls, chapter_name, mode, tempdir):
+        return kls(os.path.join(CASSETTE_DIR, chapter_name + '.json'), mode, tempdir)
+
+
+    def record(self, pos, command, tree_hash, output, files=None):
+        if output is not None:
+            output = output.replace(self.tempdir, TEMPDIR_PLACEHOLDER)
+        entry = {
+            'pos': pos,
+            'command': command,
+            'tree_hash': tree_hash,
+            'output': output,
+        }
+        if files:
+            entry['files'] = files
+        self.entries.append(entry)
+
+
+    def play(self, pos, command, tree_hash):
+        output, _ = self.play_with_files(pos, command, tree_hash)
+        return output
+
+
+    def play_with_files(self, pos, command, tree_hash):
+        candidates = [
+            e for e in self._unplayed
+            if e['pos'] == pos and e['command'] == command
+        ]
+        if not candidates:
+            raise CassetteMiss('no recorded output for {!r} at listing {} in {}'.format(
+                command, pos, self.path
+            ))
+        exact = [e for e in candidates if e['tree_hash'] == tree_hash]
+        if exact:
+            entry = exact[0]
+        else:
+            # commands aren't really run on replay, so the tree can drift
+            self.hash_mismatches += 1
+            entry = candidates[0]
+        self._unplayed.remove(entry)
+        output = entry['output']
+        if output is not None:
+            output = output.replace(TEMPDIR_PLACEHOLDER, self.tempdir)
+        return output, entry.get('files', {})
+
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump({'entries': self.entries}, f, indent=1)
+        return self.path
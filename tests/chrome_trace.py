@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Chrome trace-event (Perfetto) export for book test runs.
+
+Set CHROME_TRACE_DIR to record spans. Every test process writes its own
+trace-<pid>.json into that directory; merge them into a single timeline with:
+
+    python3 tests/chrome_trace.py CHROME_TRACE_DIR [OUTPUT]
+"""
+from contextlib import contextmanager
+import glob
+import json
+import os
+import sys
+import threading
+import time
+
+
+def now():
+    return int(time.time() * 1e6)
+
+
+class Tracer(object):
+
+    def __init__(self, trace_dir):
+        self.trace_dir = trace_dir
+        self.events = []
+
+
+    @property
+    def enabled(self):
+        return bool(self.trace_dir)
+
+
+    def add_span(self, name, cat, start, **args):
+        if not self.enabled:
+            return
+        self.events.append({
+            'name': name,
+            'cat': cat,
+            'ph': 'X',
+            'ts': start,
+            'dur': now() - start,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': args,
+        })
+
+
+    @contextmanager
+    def span(self, name, cat, **args):
+        start = now()
+        try:
+            yield
+        finally:
+            self.add_span(name, cat, start, **args)
+
+
+    def write(self):
+        if not self.enabled:
+            return
+        os.makedirs(self.trace_dir, exist_ok=True)
+        pid = os.getpid()
+        metadata = {
+            'name': 'process_name', 'ph': 'M', 'pid': pid,
+            'args': {'name': 'book tests (pid {})'.format(pid)},
+        }
+        path = os.path.join(self.trace_dir, 'trace-{}.json'.format(pid))
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': [metadata] + self.events}, f)
+        return path
+
+
+
+def merge_traces(trace_dir, output_path):
+    events = []
+    for path in sorted(glob.glob(os.path.join(trace_dir, 'trace-*.json'))):
+        with open(path) as f:
+            events.extend(json.load(f)['traceEvents'])
+    with open(output_path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    return len(events)
+
+
+TRACER = Tracer(os.environ.get('CHROME_TRACE_DIR'))
+
+
+if __name__ == '__main__':
+    trace_dir = sys.argv[1]
+    output_path = sys.argv[2] if len(sys.argv) > 2 else os.path.join(trace_dir, 'trace.json')
+    print('merged {} events into {}'.format(merge_traces(trace_dir, output_path), output_path))
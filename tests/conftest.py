@@ -0,0 +1,14 @@
+import book_tester
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        '--verify-only', action='store_true',
+        help="check listings against the book-example commits without running "
+             "any tests, servers or server commands",
+    )
+
+
+def pytest_configure(config):
+    if config.getoption('verify_only'):
+        book_tester.VERIFY_ONLY = True
@@ -0,0 +1,116 @@
+from concurrent.futures import ThreadPoolExecutor
+import atexit
+import os
+import select
+import shutil
+import socket
+import subprocess
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+from book_logging import get_logger
+
+log = get_logger('js_test_server')
+
+SERVER_SCRIPT = os.path.join(
+    os.path.abspath(os.path.dirname(__file__)),
+    'phantomjs-qunit-server.js'
+)
+# set JS_TEST_SERVER=off to go back to one phantomjs process per run
+ENABLED = os.environ.get('JS_TEST_SERVER') != 'off'
+STARTUP_TIMEOUT = 10
+RUN_TIMEOUT = 120
+
+
+class JSTestServerError(Exception):
+    pass
+
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+
+class JSTestServer(object):
+
+    def __init__(self):
+        self.process = None
+        self.port = None
+
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+
+    def start(self):
+        self.port = get_free_port()
+        self.process = subprocess.Popen(
+            ['phantomjs', SERVER_SCRIPT, str(self.port)],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True,
+        )
+        ready, _, _ = select.select([self.process.stdout], [], [], STARTUP_TIMEOUT)
+        line = self.process.stdout.readline() if ready else ''
+        if not line.startswith('listening'):
+            self.stop()
+            raise JSTestServerError('phantomjs server did not start: {!r}'.format(line))
+        # phantomjs can still print page errors, keep the pipe from filling up
+        threading.Thread(target=shutil.copyfileobj, args=(
+            self.process.stdout, open(os.devnull, 'w')
+        ), daemon=True).start()
+
+
+    def run(self, tests_path):
+        url = 'http://127.0.0.1:{}/run?path={}'.format(
+            self.port, urllib.parse.quote(os.path.abspath(tests_path))
+        )
+        with urllib.request.urlopen(url, timeout=RUN_TIMEOUT) as response:
+            return response.read().decode('utf8')
+
+
+    def run_all(self, tests_paths):
+        if len(tests_paths) == 1:
+            return [self.run(tests_paths[0])]
+        with ThreadPoolExecutor(len(tests_paths)) as executor:
+            return list(executor.map(self.run, tests_paths))
+
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        self.process.stdout.close()
+
+
+
+_server = None
+_start_failed = False
+
+
+def get_server(on_spawn=None):
+    global _server, _start_failed
+    if not ENABLED or _start_failed:
+        return None
+    if _server is not None and _server.alive:
+        return _server
+    server = JSTestServer()
+    spawn_start = time.perf_counter()
+    try:
+        server.start()
+    except (OSError, JSTestServerError) as e:
+        log.warning('could not start phantomjs server, using one process per run: %s', e)
+        _start_failed = True
+        return None
+    if on_spawn is not None:
+        on_spawn(time.perf_counter() - spawn_start)
+    atexit.register(server.stop)
+    _server = server
+    return server
@@ -0,0 +1,82 @@
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+TIMINGS_DIR = os.environ.get('TIMINGS_DIR', os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..', 'timings'
+)))
+
+
+def children_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class ListingTimings(object):
+
+    def __init__(self, chapter_name):
+        self.chapter_name = chapter_name
+        self.records = []
+        self.current = None
+
+
+    @contextmanager
+    def listing(self, pos, listing):
+        self.current = {
+            'pos': pos,
+            'type': listing.type,
+            'listing': str(listing).split('\n')[0][:60],
+            'processes': 0,
+            'output_size': 0,
+        }
+        start_time = time.perf_counter()
+        start_cpu = children_cpu_time()
+        try:
+            yield self.current
+        finally:
+            self.current['wall_time'] = round(time.perf_counter() - start_time, 4)
+            self.current['child_cpu_time'] = round(children_cpu_time() - start_cpu, 4)
+            self.records.append(self.current)
+            self.current = None
+
+
+    def record_command(self, output):
+        if self.current is None:
+            return
+        self.current['processes'] += 1
+        if output:
+            self.current['output_size'] += len(output)
+
+
+    def write(self, path=None):
+        if path is None:
+            path = os.path.join(TIMINGS_DIR, self.chapter_name + '.jsonl')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            for record in self.records:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+        return path
+
+
+    def slowest(self, count=10):
+        return sorted(self.records, key=lambda r: r['wall_time'], reverse=True)[:count]
+
+
+    def summary(self, count=10):
+        total = sum(r['wall_time'] for r in self.records)
+        lines = [
+            'slowest listings in {} ({} listings, {:.1f}s total):'.format(
+                self.chapter_name, len(self.records), total
+            ),
+            '{:>5} {:>9} {:>9} {:>5} {:>8}  {:<28} {}'.format(
+                'pos', 'wall', 'cpu', 'procs', 'output', 'type', 'listing'
+            ),
+        ]
+        for r in self.slowest(count):
+            lines.append('{:>5} {:>8.2f}s {:>8.2f}s {:>5} {:>8}  {:<28} {}'.format(
+                r['pos'], r['wall_time'], r['child_cpu_time'], r['processes'],
+                r['output_size'], r['type'], r['listing'],
+            ))
+        return '\n'.join(lines)
@@ -0,0 +1,160 @@
+from bisect import bisect_left
+from collections import Counter
+
+CONTEXT = 3
+# hunks beyond this many are summarised rather than shown
+MAX_HUNKS = 10
+# and changed runs longer than this are cut short
+MAX_HUNK_LINES = 40
+NORMALISED_MARK = '*'
+
+
+def _longest_increasing_run(pairs):
+    # patience sorting: pairs are (i, j) sorted by i, find the longest
+    # subsequence with increasing j
+    tails = []
+    tail_indexes = []
+    previous = [None] * len(pairs)
+    for index, (_, j) in enumerate(pairs):
+        pos = bisect_left(tails, j)
+        if pos:
+            previous[index] = tail_indexes[pos - 1]
+        if pos == len(tails):
+            tails.append(j)
+            tail_indexes.append(index)
+        else:
+            tails[pos] = j
+            tail_indexes[pos] = index
+    run = []
+    index = tail_indexes[-1] if tail_indexes else None
+    while index is not None:
+        run.append(pairs[index])
+        index = previous[index]
+    return run[::-1]
+
+
+def _unique_anchors(a, alo, ahi, b, blo, bhi):
+    a_counts = Counter(a[alo:ahi])
+    b_positions = {}
+    b_counts = Counter(b[blo:bhi])
+    for j in range(blo, bhi):
+        if b_counts[b[j]] == 1:
+            b_positions[b[j]] = j
+    pairs = [
+        (i, b_positions[a[i]]) for i in range(alo, ahi)
+        if a_counts[a[i]] == 1 and a[i] in b_positions
+    ]
+    return _longest_increasing_run(pairs)
+
+
+def _diff(a, alo, ahi, b, blo, bhi, opcodes):
+    start_alo, start_blo = alo, blo
+    while alo < ahi and blo < bhi and a[alo] == b[blo]:
+        alo += 1
+        blo += 1
+    if alo > start_alo:
+        opcodes.append(('equal', start_alo, alo, start_blo, blo))
+
+    end_ahi, end_bhi = ahi, bhi
+    while ahi > alo and bhi > blo and a[ahi - 1] == b[bhi - 1]:
+        ahi -= 1
+        bhi -= 1
+
+    anchors = _unique_anchors(a, alo, ahi, b, blo, bhi)
+    if not anchors:
+        if alo < ahi and blo < bhi:
+            opcodes.append(('replace', alo, ahi, blo, bhi))
+        elif alo < ahi:
+            opcodes.append(('delete', alo, ahi, blo, bhi))
+        elif blo < bhi:
+            opcodes.append(('insert', alo, ahi, blo, bhi))
+    else:
+        for i, j in anchors:
+            _diff(a, alo, i, b, blo, j, opcodes)
+            opcodes.append(('equal', i, i + 1, j, j + 1))
+            alo, blo = i + 1, j + 1
+        _diff(a, alo, ahi, b, blo, bhi, opcodes)
+
+    if ahi < end_ahi:
+        opcodes.append(('equal', ahi, end_ahi, bhi, end_bhi))
+
+
+def patience_opcodes(a, b):
+    opcodes = []
+    _diff(a, 0, len(a), b, 0, len(b), opcodes)
+    merged = []
+    for opcode in opcodes:
+        if merged and merged[-1][0] == opcode[0] == 'equal':
+            tag, i1, _, j1, _ = merged[-1]
+            merged[-1] = (tag, i1, opcode[2], j1, opcode[4])
+        else:
+            merged.append(opcode)
+    return merged or [('equal', 0, 0, 0, 0)]
+
+
+def group_opcodes(opcodes, context=CONTEXT):
+    # same as difflib.SequenceMatcher.get_grouped_opcodes
+    opcodes = list(opcodes)
+    if opcodes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = opcodes[0]
+        opcodes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    if opcodes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = opcodes[-1]
+        opcodes[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+    groups = []
+    group = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal' and i2 - i1 > 2 * context:
+            group.append((tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)))
+            groups.append(group)
+            group = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        groups.append(group)
+    return groups
+
+
+def format_mismatch(expected_lines, actual_lines, expected_normalised=(), actual_normalised=()):
+    # the *_normalised arguments are sets of line numbers rewritten by the
+    # output normalisers, so you can tell a real difference from a fixup gone wrong
+    groups = group_opcodes(patience_opcodes(expected_lines, actual_lines))
+    report = [
+        'Output did not match listing ({} expected lines, {} actual lines)'.format(
+            len(expected_lines), len(actual_lines)
+        ),
+        '--- expected',
+        '+++ actual',
+        '{} marks lines rewritten by the output normalisers'.format(NORMALISED_MARK),
+    ]
+
+    def lines(prefix, all_lines, start, end, normalised):
+        shown = []
+        for number in range(start, min(end, start + MAX_HUNK_LINES)):
+            mark = NORMALISED_MARK if number in normalised else ' '
+            shown.append('{}{} {}'.format(prefix, mark, all_lines[number]))
+        if end - start > MAX_HUNK_LINES:
+            shown.append('{}  [... {} more lines]'.format(prefix, end - start - MAX_HUNK_LINES))
+        return shown
+
+    for group in groups[:MAX_HUNKS]:
+        first, last = group[0], group[-1]
+        report.append('@@ expected {}-{}, actual {}-{} @@'.format(
+            first[1] + 1, last[2], first[3] + 1, last[4]
+        ))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                report.extend(lines(' ', actual_lines, j1, j2, actual_normalised))
+                continue
+            report.extend(lines('-', expected_lines, i1, i2, expected_normalised))
+            report.extend(lines('+', actual_lines, j1, j2, actual_normalised))
+    if len(groups) > MAX_HUNKS:
+        report.append('[... {} more differing sections not shown]'.format(
+            len(groups) - MAX_HUNKS
+        ))
+    return '\n'.join(report)
+
+
+def normalised_line_numbers(fixed_lines, raw_text):
+    raw_lines = set(raw_text.split('\n')) | set(raw_text.strip().split('\n'))
+    return {n for n, l in enumerate(fixed_lines) if l not in raw_lines}
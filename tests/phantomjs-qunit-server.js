@@ -0,0 +1,49 @@
+/*global require, phantom */
+var system = require('system');
+var webpage = require('webpage');
+var server = require('webserver').create();
+var qunitResults = require('./qunit-results');
+
+var port = system.args[1];
+if (!port){
+    console.log('Pass port to listen on as second arg');
+    phantom.exit(1);
+}
+
+// each request opens its own page, so several suites can run at once
+var listening = server.listen('127.0.0.1:' + port, function (request, response) {
+    var match = request.url.match(/^\/run\?path=(.+)$/);
+    if (!match) {
+        response.statusCode = 404;
+        response.write('unknown url ' + request.url);
+        response.close();
+        return;
+    }
+    var path = decodeURIComponent(match[1]);
+    var page = webpage.create();
+    var logs = '';
+
+    page.onConsoleMessage = function (msg) {
+      logs += msg + '\n';
+    };
+
+    // listings keep editing the same files, so never serve them from cache
+    page.clearMemoryCache();
+    page.open('file://' + path, function () {
+        setTimeout(function() {
+            var output = page.evaluate(qunitResults.getResults);
+            page.close();
+            response.statusCode = 200;
+            response.setHeader('Content-Type', 'text/plain; charset=utf-8');
+            // same as the two console.logs in my-phantomjs-qunit-runner.js
+            response.write(output + '\n' + logs + '\n');
+            response.close();
+        }, 100);
+    });
+});
+
+if (!listening) {
+    console.log('could not listen on port ' + port);
+    phantom.exit(1);
+}
+console.log('listening on ' + port);
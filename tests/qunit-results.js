@@ -0,0 +1,43 @@
+/*global exports, $ */
+
+// runs inside the page, via page.evaluate, so it must be self-contained
+exports.getResults = function () {
+    var results = '';
+
+    var headline = $('#qunit-testresult').text().split('.')[1] + '.';
+    results += headline + '\n';
+
+    var testCounter = 0;
+    $('#qunit-tests li').each(function() {
+        var li = $(this);
+        if (li.prop('id').indexOf('qunit-test-output') !== -1){
+            testCounter += 1;
+            var resultLine = '';
+            resultLine += testCounter + '. ';
+            if (li.find('.module-name').length > 0) {
+                resultLine += li.find('.module-name').text() + ': ';
+            }
+            resultLine += li.find('.test-name').text();
+            resultLine += ' ' + li.find('.counts').text();
+            resultLine = resultLine.replace('Rerun', '');
+            var fails = li.find('.fail');
+            if (fails.text()) {
+                li.find('.qunit-assert-list li').each(function (assertCounter) {
+                    var assert = $(this);
+                    resultLine += '\n';
+                    resultLine += '    ' + (assertCounter + 1) + '. ';
+                    resultLine += assert.find('.test-message').text();
+                    if (assert.find('.fail')) {
+                        assert.find('tr').each(function () {
+                            resultLine += '\n';
+                            resultLine += '        ' + $(this).text();
+                        });
+                    }
+                });
+            }
+            results += resultLine + '\n';
+        }
+    });
+
+    return results;
+};
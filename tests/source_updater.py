@@ -6,6 +6,10 @@ import os
 import re
 from textwrap import dedent
 
+from book_logging import get_logger
+
+log = get_logger('source_updater')
+
 VIEW_FINDER = re.compile(r'^def (\w+)\(request.*\):$')
 
 
@@ -184,7 +188,7 @@ class Source(object):
 
     def replace_function(self, new_lines):
         function_name = re.search(r'def (\w+)\(.*\):', new_lines[0].strip()).group(1)
-        print('replacing function', function_name)
+        log.debug('replacing function %s', function_name)
         old_function = self.functions[function_name]
         indent = get_indent(old_function.full_line)
         self.contents = '\n'.join(
@@ -196,7 +200,7 @@ class Source(object):
 
 
     def remove_function(self, function_name):
-        print('removing function %s' % (function_name,))
+        log.debug('removing function %s', function_name)
         function = self.functions[function_name]
         self.contents = '\n'.join(
             self.lines[:function.start_line] +
@@ -216,20 +220,20 @@ class Source(object):
         try:
             return [l.strip() for l in self.lines].index(start_line.strip())
         except ValueError:
-            print('no start line match for', start_line)
+            log.debug('no start line match for %s', start_line)
 
 
     def add_to_class(self, classname, new_lines):
         new_lines = dedent('\n'.join(new_lines)).strip().split('\n')
         klass = self.classes[classname]
         lines_before_class = '\n'.join(self.lines[:klass.start_line])
-        print('lines before\n', lines_before_class)
+        log.debug('lines before\n%s', lines_before_class)
         lines_after_class = '\n'.join(self.lines[klass.last_line + 1:])
-        print('lines after\n', lines_after_class)
+        log.debug('lines after\n%s', lines_after_class)
         new_class = klass.source + '\n\n\n' + '\n'.join(
             '    ' + l for l in new_lines
         )
-        print('new class\n', new_class)
+        log.debug('new class\n%s', new_class)
         self.contents = lines_before_class + '\n' + new_class + '\n' + lines_after_class
 
 
@@ -245,7 +249,7 @@ class Source(object):
             from_start = [l.strip() for l in self.lines[start_line:]].index(end_line.strip())
             return start_line + from_start
         except ValueError:
-            print('no end line match for', end_line)
+            log.debug('no end line match for %s', end_line)
 
 
     def add_imports(self, imports):
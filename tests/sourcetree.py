@@ -1,16 +1,27 @@
+from collections import Counter, defaultdict
 import getpass
+import hashlib
 import os
-import io
 import re
 import signal
 import shutil
 import subprocess
 import tempfile
+import time
+
+from book_logging import get_logger
+from cassettes import (
+    apply_tree_changes, runs_on_replay, snapshot_hash, tree_changes, tree_snapshot
+)
+from chrome_trace import TRACER
+
+log = get_logger('sourcetree')
+
 
 def strip_comments(line):
     match_python = re.match(r"^(.+\S) +#$", line)
     if match_python:
-        print('match python')
+        log.debug('match python')
         return match_python.group(1)
     match_js = re.match(r"^(.+\S) +//$", line)
     if match_js:
@@ -18,6 +29,202 @@ def strip_comments(line):
     return line
 
 
+def command_kind(command):
+    words = command.split('&&')[-1].split()
+    if not words:
+        return ''
+    if words[0] == 'git' and len(words) > 1:
+        return 'git ' + words[1]
+    if 'manage.py' in words[:-1]:
+        return 'manage.py ' + words[words.index('manage.py') + 1]
+    if words[0].startswith('python') and len(words) > 1:
+        return 'python ' + words[1]
+    return words[0]
+
+
+def trace_category(kind):
+    if kind.startswith('git '):
+        return 'git'
+    if kind in ('manage.py test', 'python functional_tests.py', 'manage.py behave'):
+        return 'django test'
+    if kind.startswith('server '):
+        return 'server'
+    return 'command'
+
+
+class ProcessRegistry(object):
+
+    def __init__(self):
+        self.counts = Counter()
+        self.spawn_times = defaultdict(float)
+
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+
+    def record(self, kind, spawn_time):
+        self.counts[kind] += 1
+        self.spawn_times[kind] += spawn_time
+
+
+    def over_budget(self, budget):
+        if isinstance(budget, dict):
+            return {
+                kind: (self.counts[kind], limit) for kind, limit in budget.items()
+                if self.counts[kind] > limit
+            }
+        if self.total > budget:
+            return {'total': (self.total, budget)}
+        return {}
+
+
+    def summary(self):
+        lines = ['{} child processes, {:.2f}s spent spawning:'.format(
+            self.total, sum(self.spawn_times.values())
+        )]
+        for kind, count in self.counts.most_common():
+            lines.append('{:>6} {:>8.3f}s  {}'.format(count, self.spawn_times[kind], kind))
+        return '\n'.join(lines)
+
+
+
+START_STATE_CACHE = os.environ.get(
+    'START_STATE_CACHE', os.path.expanduser('~/.cache/book-tester/start-states')
+)
+# every new commit on a previous chapter's branch makes a new start state,
+# so only the most recently used few of each kind are kept per chapter
+START_STATE_KEEP = int(os.environ.get('START_STATE_KEEP', 3))
+
+
+def clone_tree(source, target):
+    # reflinks give us copy-on-write for free where the filesystem supports it
+    reflinked = subprocess.call(
+        ['cp', '-a', '--reflink=always', source, target],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    if reflinked == 0:
+        return
+    shutil.rmtree(target, ignore_errors=True)
+
+    # otherwise hardlink git objects, which are never modified in place,
+    # and copy everything else, since commands like "echo >> file" would
+    # write straight through a hardlink into the cache
+    objects_dir = os.path.join(source, '.git', 'objects') + os.sep
+    def link_or_copy(src, dst):
+        if src.startswith(objects_dir):
+            try:
+                os.link(src, dst)
+                return dst
+            except OSError:
+                pass
+        return shutil.copy2(src, dst)
+    shutil.copytree(source, target, symlinks=True, copy_function=link_or_copy)
+
+
+def prune_cache_entries(directory, prefix, keep=None):
+    keep = START_STATE_KEEP if keep is None else keep
+    def last_used(path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return 0
+    entries = [
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.startswith(prefix)
+    ]
+    entries.sort(key=last_used, reverse=True)
+    for entry in entries[keep:]:
+        log.info('evicting cached start state %s', entry)
+        shutil.rmtree(entry, ignore_errors=True)
+
+
+# chapter commands say `python manage.py ...`, so it's whichever python is
+# first on the PATH they're run with
+CHAPTER_PYTHON = os.environ.get('BOOK_TESTER_PYTHON', 'python')
+# what prep_virtualenv builds its virtualenv with, for the chapters that use one
+VIRTUALENV_PYTHON = os.environ.get('BOOK_TESTER_VIRTUALENV_PYTHON', 'python3.6')
+PYCACHE_ROOT = os.environ.get(
+    'PYCACHE_ROOT', os.path.expanduser('~/.cache/book-tester/pycache')
+)
+VIRTUALENV_ROOT = os.environ.get(
+    'BOOK_TESTER_VIRTUALENV_ROOT', os.path.expanduser('~/.cache/book-tester/virtualenvs')
+)
+# PYTHONPYCACHEPREFIX only exists from 3.8, older pythons just ignore it
+PYCACHE_PREFIX_MIN_VERSION = (3, 8)
+
+_interpreter_info = {}
+
+
+def get_interpreter_info(python=CHAPTER_PYTHON, process_registry=None):
+    # (executable, version_info) of whatever `python` resolves to, or None.
+    # only asked once per interpreter, and counted by whoever asks first
+    if python not in _interpreter_info:
+        _interpreter_info[python] = None
+        spawn_start = time.perf_counter()
+        try:
+            process = subprocess.Popen(
+                [python, '-c', 'import sys; print(sys.executable); print(*sys.version_info[:3])'],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True,
+            )
+        except OSError:
+            return None
+        if process_registry is not None:
+            process_registry.record('python -c', time.perf_counter() - spawn_start)
+        output, _ = process.communicate()
+        try:
+            executable, version = output.strip().split('\n')
+            if process.returncode == 0:
+                _interpreter_info[python] = executable, tuple(int(v) for v in version.split())
+        except ValueError:
+            pass
+    return _interpreter_info[python]
+
+
+def get_pycache_prefix(python=CHAPTER_PYTHON, process_registry=None):
+    info = get_interpreter_info(python, process_registry)
+    if info is None or info[1] < PYCACHE_PREFIX_MIN_VERSION:
+        return None
+    executable, version = info
+    key = hashlib.sha1('{} {}'.format(executable, version).encode('utf8'))
+    return os.path.join(PYCACHE_ROOT, key.hexdigest()[:12])
+
+
+def get_cached_pyc_dir(prefix, path):
+    return os.path.join(prefix, os.path.abspath(path).lstrip(os.sep))
+
+
+def discard_ambiguous_pycs(prefix, root):
+    # pycs are validated against their source's mtime in whole seconds plus
+    # its size, so one compiled in the same second its source was last
+    # written can't tell a same-sized edit made straight afterwards.
+    pyc_root = get_cached_pyc_dir(prefix, root)
+    for dirpath, _, filenames in os.walk(pyc_root):
+        source_dir = os.sep + os.path.relpath(dirpath, prefix)
+        for filename in filenames:
+            if not filename.endswith('.pyc'):
+                continue
+            pyc = os.path.join(dirpath, filename)
+            source = os.path.join(source_dir, filename.split('.')[0] + '.py')
+            try:
+                source_mtime = int(os.stat(source).st_mtime)
+                if os.stat(pyc).st_mtime < source_mtime + 1:
+                    os.remove(pyc)
+            except OSError:
+                pass
+
+
+def get_shared_virtualenv_path(requirements_path, python=VIRTUALENV_PYTHON, process_registry=None):
+    # pip compiles site-packages as it installs, so sharing the virtualenv
+    # between runs means django and friends only get compiled once
+    info = get_interpreter_info(python, process_registry)
+    key = hashlib.sha1(repr(info).encode('utf8'))
+    with open(requirements_path, 'rb') as f:
+        key.update(f.read())
+    return os.path.join(VIRTUALENV_ROOT, key.hexdigest()[:12])
+
+
 BOOTSTRAP_WGET = 'wget -O bootstrap.zip https://github.com/twbs/bootstrap/releases/download/v3.3.4/bootstrap-3.3.4-dist.zip'
 
 
@@ -58,20 +265,140 @@ class ApplyCommitException(Exception):
     pass
 
 
+
+SHM_PATH = '/dev/shm'
+# set to a directory to put workspaces there, or to "disk" to never use tmpfs
+WORKSPACE_ROOT = os.environ.get('SOURCETREE_WORKSPACE')
+# a chapter with a virtualenv, node_modules and a sqlite db can get to ~1GB
+MIN_WORKSPACE_FREE = 2 * 1024 ** 3
+
+
+def available_memory():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+
+def get_workspace_root():
+    if WORKSPACE_ROOT == 'disk':
+        return None
+    if WORKSPACE_ROOT:
+        return WORKSPACE_ROOT
+    if not os.path.isdir(SHM_PATH) or not os.access(SHM_PATH, os.W_OK):
+        return None
+    stats = os.statvfs(SHM_PATH)
+    if stats.f_bavail * stats.f_frsize < MIN_WORKSPACE_FREE:
+        return None
+    memory = available_memory()
+    if memory is not None and memory < MIN_WORKSPACE_FREE:
+        return None
+    return SHM_PATH
+
+
+def make_workspace():
+    root = get_workspace_root()
+    if root is not None:
+        try:
+            return tempfile.mkdtemp(dir=root)
+        except OSError as e:
+            log.warning('could not create workspace in %s, falling back to disk: %s', root, e)
+    return tempfile.mkdtemp()
+
+
+def is_in_tempdir(path):
+    path = os.path.realpath(path)
+    return any(
+        path.startswith(os.path.realpath(tempdir) + os.sep)
+        for tempdir in (tempfile.gettempdir(), SHM_PATH)
+    )
+
+
+class FileOverlay(object):
+
+    def __init__(self, root):
+        self.root = root
+        self.pending = {}
+        self.fsync = not is_in_tempdir(root)
+
+
+    def __contains__(self, path):
+        return os.path.abspath(path) in self.pending
+
+
+    def exists(self, path):
+        return path in self or os.path.exists(path)
+
+
+    def read(self, path):
+        path = os.path.abspath(path)
+        if path in self.pending:
+            return self.pending[path]
+        with open(path) as f:
+            return f.read()
+
+
+    def write(self, path, contents):
+        self.pending[os.path.abspath(path)] = contents
+
+
+    def flush(self):
+        for path, contents in sorted(self.pending.items()):
+            dirname = os.path.dirname(path)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            with open(path, 'w') as f:
+                f.write(contents)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+        self.pending.clear()
+
+
+
 class SourceTree(object):
 
     def __init__(self):
-        self.tempdir = tempfile.mkdtemp()
+        self.tempdir = make_workspace()
+        self.overlay = FileOverlay(self.tempdir)
         self.processes = []
         self.dev_server_running = False
+        self.timings = None
+        self.process_registry = ProcessRegistry()
+        self.cassette = None
+        self.listing_pos = None
+        self.chapter = None
+        self._pycache_prefix = None
+        self._pycache_prefix_known = False
+
+
+    @property
+    def pycache_prefix(self):
+        # asking the interpreter costs a process, so wait until a command needs it
+        if not self._pycache_prefix_known:
+            self.pycache_prefix = get_pycache_prefix(process_registry=self.process_registry)
+        return self._pycache_prefix
+
+
+    @pycache_prefix.setter
+    def pycache_prefix(self, prefix):
+        self._pycache_prefix = prefix
+        self._pycache_prefix_known = True
 
 
     def get_contents(self, path):
-        with open(os.path.join(self.tempdir, 'superlists', path)) as f:
-            return f.read()
+        return self.overlay.read(os.path.join(self.tempdir, 'superlists', path))
+
+
+    def flush(self):
+        self.overlay.flush()
 
 
     def cleanup(self):
+        self.flush()
         for process in self.processes:
             try:
                 os.killpg(process.pid, signal.SIGTERM)
@@ -79,9 +406,57 @@ class SourceTree(object):
                 pass
         if getpass.getuser() != 'harry':
             shutil.rmtree(self.tempdir)
+            # the tempdir is new every run, so its pycs can only be reused
+            # within one.  it's django and friends, at stable paths, that
+            # get to share the prefix across runs
+            if self._pycache_prefix is not None:
+                shutil.rmtree(
+                    get_cached_pyc_dir(self._pycache_prefix, self.tempdir), ignore_errors=True
+                )
+
+
+    def get_env(self):
+        env = dict(os.environ)
+        if self.pycache_prefix is None:
+            # no prefix support, so bytecode would land in the tree and in `tree` listings
+            return env
+        env['PYTHONPYCACHEPREFIX'] = self.pycache_prefix
+        # the prefix keeps bytecode out of the tree, so there's no reason not to cache it
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        return env
+
+
+    def run_command(
+        self, command, cwd=None, user_input=None, ignore_errors=False, silent=False,
+        line_checker=None,
+    ):
+        self.flush()
+        if self.cassette is None or command == BOOTSTRAP_WGET or runs_on_replay(command):
+            with TRACER.span('subprocess', 'subprocess', command=command):
+                return self._run_command(
+                    command, cwd, user_input, ignore_errors, silent, line_checker
+                )
+
+        superlists = os.path.join(self.tempdir, 'superlists')
+        before = tree_snapshot(superlists)
+        state = snapshot_hash(before)
+        if self.cassette.mode == 'replay':
+            output, files = self.cassette.play_with_files(self.listing_pos, command, state)
+            apply_tree_changes(superlists, files)
+            if output and not silent:
+                log.debug(output)
+            return output
+        with TRACER.span('subprocess', 'subprocess', command=command):
+            output = self._run_command(
+                command, cwd, user_input, ignore_errors, silent, line_checker
+            )
+        self.cassette.record(
+            self.listing_pos, command, state, output, tree_changes(superlists, before)
+        )
+        return output
 
 
-    def run_command(self, command, cwd=None, user_input=None, ignore_errors=False, silent=False):
+    def _run_command(self, command, cwd, user_input, ignore_errors, silent, line_checker=None):
         if cwd is None:
             cwd = os.path.join(self.tempdir, 'superlists')
 
@@ -94,37 +469,85 @@ class SourceTree(object):
         actual_command = command
         if command.startswith('fab deploy'):
             actual_command = 'cd deploy_tools && ' + command
+        kind = command_kind(command)
+        if self.pycache_prefix is not None and not kind.startswith('git '):
+            discard_ambiguous_pycs(self.pycache_prefix, self.tempdir)
+        spawn_start = time.perf_counter()
         process = subprocess.Popen(
             actual_command, shell=True, cwd=cwd, executable='/bin/bash',
+            env=self.get_env(),
             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
             stdin=subprocess.PIPE,
             preexec_fn=os.setsid,
             universal_newlines=True,
         )
+        self.process_registry.record(kind, time.perf_counter() - spawn_start)
         process._command = command
         self.processes.append(process)
         if 'runserver' in command:
             # can't read output, stdout.read just hangs.
+            if self.timings is not None:
+                self.timings.record_command(None)
             return
 
         if user_input and not user_input.endswith('\n'):
             user_input += '\n'
         if user_input:
-            print('sending user input: {}'.format(user_input))
-        output, _ = process.communicate(user_input)
+            log.debug('sending user input: %s', user_input)
+        with TRACER.span(kind, trace_category(kind), command=command):
+            if line_checker is not None and not user_input:
+                output = self._stream_output(process, line_checker)
+            else:
+                output, _ = process.communicate(user_input)
+        if self.timings is not None:
+            self.timings.record_command(output)
         if process.returncode and not ignore_errors:
             if 'test' in command or 'diff' in command or 'migrate' in command:
                 return output
-            print('process %s return a non-zero code (%s)' % (command, process.returncode))
-            print('output:\n', output)
+            log.error('process %s return a non-zero code (%s)', command, process.returncode)
+            log.error('output:\n%s', output)
             raise Exception('process %s return a non-zero code (%s)' % (command, process.returncode))
         if not silent:
+            log.debug(output)
+        return output
+
+
+    def check_output(self, args, kind):
+        # for commands that don't run in the tempdir, like the ones sent to
+        # the server, so they still count towards the registry and timings
+        spawn_start = time.perf_counter()
+        process = subprocess.Popen(args, stdout=subprocess.PIPE)
+        self.process_registry.record(kind, time.perf_counter() - spawn_start)
+        with TRACER.span(kind, trace_category(kind), command=args[-1]):
+            output, _ = process.communicate()
+        output = output.decode('utf8')
+        if self.timings is not None:
+            self.timings.record_command(output)
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, args, output)
+        return output
+
+
+    def _stream_output(self, process, line_checker):
+        process.stdin.close()
+        lines = []
+        try:
+            for line in process.stdout:
+                lines.append(line)
+                line_checker(line)
+        except Exception:
+            # no point waiting for the rest of a run that has already failed
             try:
-                print(output)
-            except io.BlockingIOError as e:
-                print(e)
+                os.killpg(process.pid, signal.SIGTERM)
+            except OSError:
                 pass
-        return output
+            process.stdout.close()
+            process.wait()
+            log.debug('output before stopping:\n%s', ''.join(lines))
+            raise
+        process.stdout.close()
+        process.wait()
+        return ''.join(lines)
 
 
     def get_local_repo_path(self, chapter_name):
@@ -134,19 +557,93 @@ class SourceTree(object):
         ))
 
 
+    def get_start_state_path(self, chapter, previous_chapter):
+        try:
+            sha = subprocess.check_output(
+                ['git', 'rev-parse', '--verify', '-q', 'refs/heads/' + previous_chapter],
+                cwd=self.get_local_repo_path(chapter), stderr=subprocess.DEVNULL,
+            ).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        return os.path.join(START_STATE_CACHE, chapter, '{}-{}'.format(previous_chapter, sha))
+
+
     def start_with_checkout(self, chapter, previous_chapter):
-        print('starting with checkout')
-        self.run_command('mkdir superlists', cwd=self.tempdir)
-        self.run_command('git init .')
-        self.run_command('git remote add repo "{}"'.format(
-            self.get_local_repo_path(chapter)
-        ))
-        self.run_command('git fetch repo')
-        self.run_command('git reset --hard repo/{}'.format(previous_chapter))
-        print(self.run_command('git status'))
+        # only the git checkout is cached here. the virtualenv is shared
+        # between runs by prep_virtualenv already, and the migrated database
+        # depends on whatever the chapter does to its models before calling
+        # prep_database, so that's cached separately, keyed on the tree.
+        log.info('starting with checkout')
+        superlists = os.path.join(self.tempdir, 'superlists')
+        start_state = self.get_start_state_path(chapter, previous_chapter)
+
+        if start_state and os.path.exists(start_state):
+            log.info('cloning cached start state %s', start_state)
+            os.utime(start_state)
+            clone_tree(start_state, superlists)
+            # the chapter branch may have moved on since the cache was made
+            self.run_command('git fetch repo')
+        else:
+            self.run_command('mkdir superlists', cwd=self.tempdir)
+            self.run_command('git init .')
+            self.run_command('git remote add repo "{}"'.format(
+                self.get_local_repo_path(chapter)
+            ))
+            self.run_command('git fetch repo')
+            self.run_command('git reset --hard repo/{}'.format(previous_chapter))
+            if start_state:
+                self.save_start_state(superlists, start_state, previous_chapter + '-')
+
+        log.debug(self.run_command('git status'))
         self.chapter = chapter
 
 
+    def save_start_state(self, source, start_state, prefix):
+        cache_dir = os.path.dirname(start_state)
+        os.makedirs(cache_dir, exist_ok=True)
+        in_progress = tempfile.mkdtemp(dir=cache_dir)
+        clone_tree(source, os.path.join(in_progress, 'state'))
+        try:
+            os.rename(os.path.join(in_progress, 'state'), start_state)
+        except OSError:
+            pass  # someone else got there first
+        shutil.rmtree(in_progress, ignore_errors=True)
+        prune_cache_entries(cache_dir, prefix)
+
+
+    def get_database_cache_path(self):
+        # replayed migrations never touch the disk, so there'd be nothing to save
+        if self.chapter is None or self.cassette is not None:
+            return None
+        # the schema comes from the tree's migrations plus django's own,
+        # and django comes with the interpreter
+        key = hashlib.sha1(snapshot_hash(
+            tree_snapshot(os.path.join(self.tempdir, 'superlists'))
+        ).encode('utf8'))
+        key.update(repr(get_interpreter_info(
+            process_registry=self.process_registry
+        )).encode('utf8'))
+        return os.path.join(
+            START_STATE_CACHE, self.chapter, 'database-' + key.hexdigest()[:12]
+        )
+
+
+    def restore_database(self, cached):
+        if cached is None or not os.path.exists(cached):
+            return False
+        log.info('cloning cached database %s', cached)
+        os.utime(cached)
+        clone_tree(cached, os.path.join(self.tempdir, 'database'))
+        return True
+
+
+    def save_database(self, cached):
+        if cached is not None:
+            self.save_start_state(
+                os.path.join(self.tempdir, 'database'), cached, 'database-'
+            )
+
+
     def get_commit_spec(self, commit_ref):
         return 'repo/{chapter}^{{/--{commit_ref}--}}'.format(chapter=self.chapter, commit_ref=commit_ref)
 
@@ -175,7 +672,7 @@ class SourceTree(object):
     def apply_listing_from_commit(self, listing):
         commit_spec = self.get_commit_spec(listing.commit_ref)
         commit_info = self.run_command('git show %s' % (commit_spec,))
-        print('Applying listing from commit.\nListing:\n' + listing.contents)
+        log.debug('Applying listing from commit.\nListing:\n%s', listing.contents)
 
         commit = Commit.from_diff(commit_info)
 
@@ -192,7 +689,7 @@ class SourceTree(object):
 
         self.patch_from_commit(listing.commit_ref, listing.filename)
         listing.was_written = True
-        print('applied commit.')
+        log.debug('applied commit.')
 
 
 
@@ -246,7 +743,7 @@ def check_listing_matches_commit(listing, commit, future_contents):
                 # skip duped lines
                 # (no way of telling whether dupe is 1st or 2nd)
                 assert line in commit.lines_to_add
-                print('skipping a dupe commit line')
+                log.debug('skipping a dupe commit line')
                 continue
             try:
                 line_pos_in_commit = commit.lines_to_add[line_pos_in_commit:].index(line)
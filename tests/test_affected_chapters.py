@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+import glob
+import os
+import unittest
+
+from affected_chapters import (
+    BASE_FOLDER,
+    get_affected_tests,
+    get_book_chapters,
+    get_chapter_tests,
+)
+
+CHAPTER_TESTS = {
+    'chapter_01': 'tests/test_chapter_01.py',
+    'chapter_mocking': 'tests/test_chapter_mocking.py',
+    'appendix_bdd': 'tests/test_appendix_bdd.py',
+}
+BOOK_CHAPTERS = ['preface', 'chapter_01', 'chapter_mocking', 'appendix_bdd']
+
+
+class GetAffectedTestsTest(unittest.TestCase):
+
+    def assert_affected(self, changed_files, expected):
+        self.assertEqual(
+            get_affected_tests(changed_files, CHAPTER_TESTS, BOOK_CHAPTERS),
+            expected
+        )
+
+
+    def test_maps_asciidoc_files_to_chapter_tests(self):
+        self.assert_affected(
+            ['chapter_mocking.asciidoc', 'preface.asciidoc', 'README.md'],
+            ['tests/test_chapter_mocking.py']
+        )
+
+
+    def test_maps_submodule_changes_to_their_chapter(self):
+        self.assert_affected(
+            ['source/appendix_bdd/superlists'], ['tests/test_appendix_bdd.py']
+        )
+
+
+    def test_changed_chapter_test_runs_itself(self):
+        self.assert_affected(['tests/test_chapter_01.py'], ['tests/test_chapter_01.py'])
+
+
+    def test_harness_changes_run_everything(self):
+        self.assert_affected(['tests/sourcetree.py'], sorted(CHAPTER_TESTS.values()))
+        self.assert_affected(['requirements.txt'], sorted(CHAPTER_TESTS.values()))
+
+
+    def test_unit_tests_and_benchmarks_are_not_harness(self):
+        self.assert_affected(['tests/test_sourcetree.py', 'tests/benchmarks.py'], [])
+
+
+
+class RealBookTest(unittest.TestCase):
+
+    def test_every_chapter_test_is_a_book_chapter(self):
+        chapter_tests = get_chapter_tests()
+        self.assertEqual(chapter_tests['chapter_01'], 'tests/test_chapter_01.py')
+        self.assertLessEqual(set(chapter_tests), set(get_book_chapters()))
+
+
+    def test_never_selects_more_than_the_full_run(self):
+        full_run = sorted(
+            os.path.relpath(path, BASE_FOLDER)
+            for path in glob.glob(os.path.join(BASE_FOLDER, 'tests', 'test_chapter*.py'))
+        )
+        self.assertEqual(
+            get_affected_tests(['tests/sourcetree.py'], get_chapter_tests(), get_book_chapters()),
+            full_run
+        )
+        self.assertNotIn('appendix_bdd', get_chapter_tests())
+
+
+if __name__ == '__main__':
+    unittest.main()
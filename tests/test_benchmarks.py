@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+import unittest
+
+from lxml import html
+
+from benchmarks import (
+    BENCHMARKS,
+    find_regressions,
+    scale_listing_html,
+)
+from book_parser import parse_listing
+from examples import CODE_LISTING_WITH_CAPTION
+
+
+class ScaleListingHtmlTest(unittest.TestCase):
+
+    def test_repeats_listing_contents(self):
+        [listing] = parse_listing(html.fromstring(CODE_LISTING_WITH_CAPTION))
+        [scaled] = parse_listing(html.fromstring(
+            scale_listing_html(CODE_LISTING_WITH_CAPTION, 10)
+        ))
+        self.assertEqual(scaled.filename, listing.filename)
+        self.assertEqual(
+            len(scaled.contents.split('\n')),
+            10 * len(listing.contents.split('\n')),
+        )
+
+
+
+class FindRegressionsTest(unittest.TestCase):
+
+    def test_flags_only_slowdowns_over_threshold(self):
+        baseline = {'parse_listing': {'1': 1.0, '10': 1.0}, 'other': {'1': 1.0}}
+        results = {'parse_listing': {'1': 1.4, '10': 1.6}, 'other': {'1': 0.5}}
+        self.assertEqual(
+            find_regressions(baseline, results, threshold=1.5),
+            [('parse_listing', '10', 1.0, 1.6)]
+        )
+
+
+    def test_ignores_benchmarks_missing_from_baseline(self):
+        self.assertEqual(find_regressions({}, {'new': {'1': 1.0}}, 1.5), [])
+
+
+
+class BenchmarksRunTest(unittest.TestCase):
+
+    def test_all_benchmarks_run_at_smallest_scale(self):
+        for name, make_benchmark in BENCHMARKS:
+            run = make_benchmark(1)
+            run()
+            if hasattr(run, 'cleanup'):
+                run.cleanup()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+import gzip
+import io
+import logging
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from book_logging import (
+    ConsoleHandler,
+    get_logger,
+    start_chapter_log,
+    stop_chapter_log,
+)
+
+
+class ChapterLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+
+    def test_writes_everything_to_compressed_chapter_log(self):
+        handler = start_chapter_log('chapter_foo', log_dir=self.log_dir)
+        get_logger('sourcetree').debug('some command output')
+        get_logger('sourcetree').info('progress')
+        path = stop_chapter_log(handler)
+        get_logger('sourcetree').debug('after the chapter')
+
+        assert path.endswith('chapter_foo.log.gz')
+        with gzip.open(path, 'rt') as f:
+            contents = f.read()
+        self.assertIn('DEBUG book_tester.sourcetree: some command output', contents)
+        self.assertIn('INFO book_tester.sourcetree: progress', contents)
+        self.assertNotIn('after the chapter', contents)
+
+
+
+class ConsoleHandlerTest(unittest.TestCase):
+
+    def log_to_console(self, handler, level, message):
+        record = logging.LogRecord('book_tester', level, __file__, 1, message, None, None)
+        if record.levelno >= handler.level:
+            handler.handle(record)
+
+
+    def test_quiet_mode_only_shows_progress(self):
+        handler = ConsoleHandler(logging.INFO)
+        with patch('sys.stdout', io.StringIO()) as stdout:
+            self.log_to_console(handler, logging.DEBUG, 'pip install spam')
+            self.log_to_console(handler, logging.INFO, 'listing 3/10: code listing')
+        self.assertEqual(stdout.getvalue(), 'listing 3/10: code listing\n')
+
+
+    def test_truncates_huge_messages(self):
+        handler = ConsoleHandler(logging.DEBUG)
+        handler.log_path = '/logs/chapter_foo.log.gz'
+        with patch('book_logging.MAX_CONSOLE_CHARS', 10), \
+                patch('sys.stdout', io.StringIO()) as stdout:
+            self.log_to_console(handler, logging.DEBUG, 'x' * 25)
+        self.assertEqual(
+            stdout.getvalue(),
+            'x' * 10 + '\n[... 15 more chars, see /logs/chapter_foo.log.gz]\n'
+        )
+
+
+    def test_doesnt_block_on_busy_terminal(self):
+        handler = ConsoleHandler(logging.DEBUG)
+        with patch('sys.stdout') as stdout:
+            stdout.write.side_effect = BlockingIOError
+            self.log_to_console(handler, logging.DEBUG, 'lots of output')  # should not raise
+
+
+if __name__ == '__main__':
+    unittest.main()
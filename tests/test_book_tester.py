@@ -1,18 +1,25 @@
 #!/usr/bin/env python3
 import os
+import shutil
+import tempfile
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 from textwrap import dedent
 
 from book_tester import (
     ChapterTest,
     PHANTOMJS_RUNNER,
+    StreamingOutputCheck,
     contains,
+    executes_code,
+    fix_phantomjs_output,
     wrap_long_lines,
     split_blocks,
 
 )
+from cassettes import Cassette
 from book_parser import (
+    CodeListing,
     Command,
     Output,
 )
@@ -20,6 +27,15 @@ from test_write_to_file import *  # noqa
 from test_book_parser import *  # noqa
 from test_source_updater import *  # noqa
 from test_sourcetree import *  # noqa
+from test_listing_timings import *  # noqa
+from test_chrome_trace import *  # noqa
+from test_benchmarks import *  # noqa
+from test_affected_chapters import *  # noqa
+from test_cassettes import *  # noqa
+from test_js_test_server import *  # noqa
+from test_book_logging import *  # noqa
+from test_output_diff import *  # noqa
+from test_build_book import *  # noqa
 
 
 
@@ -134,78 +150,273 @@ class RunCommandTest(ChapterTest):
 
 
 
+class ProcessBudgetTest(ChapterTest):
+
+    def test_no_budget_means_no_check(self):
+        self.sourcetree.run_command('true', cwd=self.tempdir)
+        self.check_process_budget()
+
+
+    def test_fails_when_total_budget_exceeded(self):
+        self.process_budget = 1
+        self.sourcetree.run_command('true', cwd=self.tempdir)
+        self.check_process_budget()
+        self.sourcetree.run_command('true', cwd=self.tempdir)
+        with self.assertRaises(AssertionError) as e:
+            self.check_process_budget()
+        self.assertIn('total: 2 spawned, budget 1', str(e.exception))
+        self.process_budget = None
+
+
+    def test_budget_by_command_kind(self):
+        self.process_budget = {'git status': 1}
+        self.sourcetree.run_command('git init .', cwd=self.tempdir)
+        self.sourcetree.run_command('git init .', cwd=self.tempdir)
+        self.sourcetree.run_command('git status', cwd=self.tempdir)
+        self.check_process_budget()
+        self.sourcetree.run_command('git status', cwd=self.tempdir)
+        with self.assertRaises(AssertionError):
+            self.check_process_budget()
+        self.process_budget = None
+
+
+
+class PrepVirtualenvTest(ChapterTest):
+
+    def test_reuses_shared_virtualenv_across_runs(self):
+        virtualenv_root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tempdir, 'superlists'))
+        with open(os.path.join(self.tempdir, 'superlists', 'requirements.txt'), 'w') as f:
+            f.write('django==1.11\n')
+        self.sourcetree.check_output = Mock(side_effect=lambda args, kind: (
+            os.makedirs(args[-1]) if kind == 'python -m venv' else None
+        ))
+        # an empty cassette: the venv has to be built for real, not replayed
+        cassette_path = os.path.join(virtualenv_root, 'cassette.json')
+        Cassette(cassette_path, 'record', self.tempdir).save()
+        self.sourcetree.cassette = Cassette(cassette_path, 'replay', self.tempdir)
+        with patch('sourcetree.VIRTUALENV_ROOT', virtualenv_root):
+            self.prep_virtualenv()
+            commands = [c[0][0] for c in self.sourcetree.check_output.call_args_list]
+            assert len(commands) == 2
+            shared_path = commands[0][-1]
+            assert shared_path.startswith(virtualenv_root)
+            assert os.path.realpath(os.path.join(self.tempdir, 'virtualenv')) == shared_path
+
+            os.remove(os.path.join(self.tempdir, 'virtualenv'))
+            self.sourcetree.check_output.reset_mock()
+            self.prep_virtualenv()
+            assert not self.sourcetree.check_output.called
+            assert os.path.realpath(os.path.join(self.tempdir, 'virtualenv')) == shared_path
+        shutil.rmtree(virtualenv_root)
+
+
+
+class VerifyOnlyTest(ChapterTest):
+
+    def setUp(self):
+        super().setUp()
+        os.makedirs(os.path.join(self.tempdir, 'superlists'))
+        self.listings = [
+            CodeListing(filename='foo.txt', contents='hello'),
+            Command('python manage.py test lists'),
+            Output('Ran 1 test in 0.001s\n\nOK'),
+            Command('ls'),
+            Output('foo.txt'),
+            Command('python manage.py migrate'),
+            Output('Do you want to continue?'),
+            Command('yes'),
+            Output('Done'),
+            Output('FAILED (errors=1)'),
+        ]
+
+
+    def test_only_skips_the_output_attached_to_a_skipped_command(self):
+        with patch('book_tester.VERIFY_ONLY', True):
+            self.pos = 5
+            self.recognise_listing_and_process_it()
+            # migrate, its prompt, the answer and what came after that
+            self.assertEqual(self.pos, 9)
+            # but the standalone test output is a listing of its own
+            self.assertFalse(self.listings[9].was_checked)
+
+        self.listings = [
+            Command('python manage.py test lists'),
+            Output('superlists\n├── lists\n└── manage.py'),
+        ]
+        self.pos = 0
+        with patch('book_tester.VERIFY_ONLY', True):
+            self.recognise_listing_and_process_it()
+        self.assertEqual(self.pos, 1)
+        self.assertFalse(self.listings[1].was_checked)
+
+
+    def test_only_skips_test_runners_and_commands_needing_a_server(self):
+        for command in [
+            'python manage.py test lists',
+            'python3 manage.py runserver',
+            'python manage.py migrate --noinput',
+            'python functional_tests.py',
+            'STAGING_SERVER=foo python manage.py test functional_tests',
+            'source ../virtualenv/bin/activate && ./manage.py test',
+            'pip install -r requirements.txt',
+            'fab deploy:host=foo',
+        ]:
+            self.assertTrue(executes_code(Command(command)), command)
+        for command in [
+            'mkdir functional_tests',
+            'touch functional_tests/__init__.py',
+            'git mv functional_tests.py functional_tests/tests.py',
+            'git add functional_tests',
+            'cp functional_tests/base.py functional_tests/test_list.py',
+            'pip freeze | grep gunicorn >> requirements.txt',
+            'python manage.py startapp lists',
+            'python manage.py makemigrations',
+        ]:
+            self.assertFalse(executes_code(Command(command)), command)
+
+
+    def test_skips_executing_listings_but_writes_code_and_runs_other_commands(self):
+        self.run_command = Mock(wraps=self.run_command)
+        with patch('book_tester.VERIFY_ONLY', True):
+            while self.pos < len(self.listings):
+                self.recognise_listing_and_process_it()
+
+        self.assert_all_listings_checked(self.listings)
+        self.assertEqual(
+            [c[0][0] for c in self.run_command.call_args_list],
+            ['ls']
+        )
+        self.assertEqual(self.sourcetree.get_contents('foo.txt'), 'hello\n')
+
+
+    def test_prep_steps_are_skipped(self):
+        self.sourcetree.run_command = Mock()
+        with patch('book_tester.VERIFY_ONLY', True):
+            self.prep_virtualenv()
+            self.prep_database()
+            self.start_dev_server()
+            self.restart_dev_server()
+        self.assertFalse(self.sourcetree.run_command.called)
+
+
+
+    def test_runs_commands_that_generate_files_so_final_diff_matches(self):
+        self.chapter_name = 'chapter_startapp'
+        superlists = os.path.join(self.tempdir, 'superlists')
+        with open(os.path.join(superlists, 'manage.py'), 'w') as f:
+            # stands in for django's, just enough to generate an app
+            f.write(dedent(
+                """
+                import os, sys
+                if sys.argv[1] == 'startapp':
+                    os.makedirs(sys.argv[2])
+                    with open(os.path.join(sys.argv[2], 'models.py'), 'w') as f:
+                        f.write('from django.db import models\\n')
+                """
+            ))
+        for command in [
+            'git init -q .', 'git add manage.py',
+            'git -c user.name=a -c user.email=a@b commit -qm start',
+            'python3 manage.py startapp lists', 'git add lists',
+            'git -c user.name=a -c user.email=a@b commit -qm lists',
+            'git branch repo/chapter_startapp', 'git reset -q --hard HEAD~1',
+        ]:
+            self.sourcetree.run_command(command, cwd=superlists)
+        assert not os.path.exists(os.path.join(superlists, 'lists'))
+        self.listings = [
+            Command('python3 manage.py startapp lists'),
+            Command('git add lists'),
+            Command('python manage.py test lists'),
+            Output('OK'),
+        ]
+
+        with patch('book_tester.VERIFY_ONLY', True):
+            while self.pos < len(self.listings):
+                self.recognise_listing_and_process_it()
+            self.check_final_diff()
+        self.assert_all_listings_checked(self.listings)
+
+
+
 class RunServerCommandTest(ChapterTest):
 
-    @patch('book_tester.subprocess')
-    def test_uses_python2_run_server_command(self, mock_subprocess):
-        mock_subprocess.check_output.return_value = b'some bytes'
+    @patch('sourcetree.SourceTree.check_output')
+    def test_uses_python2_run_server_command(self, mock_check_output):
+        mock_check_output.return_value = 'some bytes'
         result = self.run_server_command('foo bar')
         assert result == 'some bytes'
-        mock_subprocess.check_output.assert_called_with(
+        mock_check_output.assert_called_with(
             ['python2.7', self.RUN_SERVER_PATH, 'foo bar'],
+            'server command',
         )
 
 
-    @patch('book_tester.subprocess')
-    def test_hacks_in_dash_y_for_apt_gets(self, mock_subprocess):
-        mock_subprocess.check_output.return_value = b'some bytes'
+    @patch('sourcetree.SourceTree.check_output')
+    def test_hacks_in_dash_y_for_apt_gets(self, mock_check_output):
+        mock_check_output.return_value = 'some bytes'
         result = self.run_server_command('sudo apt-get install something')
         assert result == 'some bytes'
         self.RUN_SERVER_PATH = os.path.abspath(
             os.path.join(os.path.dirname(__file__), 'run_server_command.py')
         )
-        mock_subprocess.check_output.assert_called_with(
+        mock_check_output.assert_called_with(
             ['python2.7', self.RUN_SERVER_PATH, 'sudo apt-get install -y something'],
+            'server command',
         )
 
 
-    @patch('book_tester.subprocess')
-    def test_hacks_in_SITENAME_if_needed(self, mock_subprocess):
-        mock_subprocess.check_output.return_value = b'some bytes'
+    @patch('sourcetree.SourceTree.check_output')
+    def test_hacks_in_SITENAME_if_needed(self, mock_check_output):
+        mock_check_output.return_value = 'some bytes'
         result = self.run_server_command('mkdir /foo/$SITENAME')
         assert result == 'some bytes'
         self.RUN_SERVER_PATH = os.path.abspath(
             os.path.join(os.path.dirname(__file__), 'run_server_command.py')
         )
-        mock_subprocess.check_output.assert_called_with(
+        mock_check_output.assert_called_with(
             ['python2.7', self.RUN_SERVER_PATH, 'SITENAME=superlists-staging.ottg.eu; mkdir /foo/$SITENAME'],
+            'server command',
         )
         # but not for the export itself
         self.run_server_command('export SITENAME=foo')
-        mock_subprocess.check_output.assert_called_with(
+        mock_check_output.assert_called_with(
             ['python2.7', self.RUN_SERVER_PATH, 'export SITENAME=foo'],
+            'server command',
         )
 
 
-    @patch('book_tester.subprocess')
-    def test_hacks_in_cd_if_one_set_by_last_command(self, mock_subprocess):
-        mock_subprocess.check_output.return_value = b'some bytes'
+    @patch('sourcetree.SourceTree.check_output')
+    def test_hacks_in_cd_if_one_set_by_last_command(self, mock_check_output):
+        mock_check_output.return_value = 'some bytes'
         assert self.current_server_cd is None
         self.run_server_command('cd /foo')
         assert self.current_server_cd == '/foo'
         self.run_server_command('do something')
-        mock_subprocess.check_output.assert_called_with(
+        mock_check_output.assert_called_with(
             ['python2.7', self.RUN_SERVER_PATH, 'cd /foo && do something'],
+            'server command',
         )
 
 
-    @patch('book_tester.subprocess')
-    def test_hacks_in_cd_correctly_when_theres_also_a_SITENAME(self, mock_subprocess):
-        mock_subprocess.check_output.return_value = b'some bytes'
+    @patch('sourcetree.SourceTree.check_output')
+    def test_hacks_in_cd_correctly_when_theres_also_a_SITENAME(self, mock_check_output):
+        mock_check_output.return_value = 'some bytes'
         assert self.current_server_cd is None
         self.run_server_command('cd /foo/$SITENAME')
         self.run_server_command('do something')
-        mock_subprocess.check_output.assert_called_with(
+        mock_check_output.assert_called_with(
             ['python2.7', self.RUN_SERVER_PATH, 'SITENAME=superlists-staging.ottg.eu; cd /foo/$SITENAME && do something'],
+            'server command',
         )
 
 
-    @patch('book_tester.subprocess')
-    def DONTtest_hacks_in_dtach_for_runserver(self, mock_subprocess):
-        mock_subprocess.check_output.return_value = b'some bytes'
+    @patch('sourcetree.SourceTree.check_output')
+    def DONTtest_hacks_in_dtach_for_runserver(self, mock_check_output):
+        mock_check_output.return_value = 'some bytes'
         self.run_server_command('cd /foo/$SITENAME')
         self.run_server_command('source ../virtualenv/bin/activate && python3 manage.py runserver')
-        mock_subprocess.check_output.assert_called_with(
+        mock_check_output.assert_called_with(
             [
                 'python2.7',
                 self.RUN_SERVER_PATH,
@@ -213,6 +424,7 @@ class RunServerCommandTest(ChapterTest):
                 ' cd /foo/$SITENAME && source ../virtualenv/bin/activate'
                 ' && dtach -n /tmp/dtach.sock python3 manage.py runserver'
             ],
+            'server command',
         )
 
 
@@ -809,6 +1021,105 @@ class AssertConsoleOutputCorrectTest(ChapterTest):
         self.assertTrue(expected.was_checked)
 
 
+    def test_mismatch_report_shows_differing_lines_and_normalisations(self):
+        expected = Output(dedent(
+            """
+            .F
+            ======================================================================
+            FAIL: test_foo (lists.tests.FooTest)
+            AssertionError: 1 != 2
+
+            Ran 2 tests in 0.002s
+
+            FAILED (failures=1)
+            """).strip()
+        )
+        actual = expected.replace(
+            'AssertionError: 1 != 2', 'AssertionError: 1 != 2\nsomething else'
+        ).replace('0.002s', '0.123s')
+        with self.assertRaises(AssertionError) as cm:
+            self.assert_console_output_correct(actual, expected)
+        report = str(cm.exception)
+        self.assertIn('   AssertionError: 1 != 2\n+  something else', report)
+        self.assertIn(' * Ran 2 tests in X.Xs', report)
+
+
+
+class StreamingOutputCheckTest(unittest.TestCase):
+
+    expected = dedent(
+        """
+        Creating test database for alias 'default'...
+        F
+        ======================================================================
+        FAIL: test_home_page (lists.tests.HomePageTest)
+        AssertionError: 'foo' != 'bar'
+
+         ---------------------------------------------------------------------
+        Ran 1 test in 0.003s
+
+        FAILED (failures=1)
+        """
+    )
+
+    def feed(self, check, actual):
+        for line in actual.split('\n'):
+            check(line + '\n')
+
+
+    def test_accepts_output_matching_after_normalisation(self):
+        check = StreamingOutputCheck(Output(self.expected), '/tmp/tmpxyz')
+        assert check.enabled
+        self.feed(check, dedent(
+            """
+            F
+            ======================================================================
+            FAIL: test_home_page (lists.tests.HomePageTest)
+            AssertionError: 'foo'   !=   'bar'
+            ----------------------------------------------------------------------
+            Ran 1 test in 0.250s
+            Creating test database for alias 'default'...
+
+            FAILED (failures=1)
+            """
+        ))  # should not raise
+
+
+    def test_raises_as_soon_as_a_line_diverges(self):
+        check = StreamingOutputCheck(Output(self.expected), '/tmp/tmpxyz')
+        check('F\n')
+        check('=' * 70 + '\n')
+        with self.assertRaises(AssertionError) as cm:
+            check('ERROR: test_home_page (lists.tests.HomePageTest)\n')
+        self.assertIn('expected: FAIL: test_home_page', str(cm.exception))
+        self.assertIn('actual:   ERROR: test_home_page', str(cm.exception))
+
+
+    def test_raises_if_output_carries_on_past_the_listing(self):
+        check = StreamingOutputCheck(Output(self.expected), '/tmp/tmpxyz')
+        with self.assertRaises(AssertionError):
+            self.feed(check, self.expected + '\nTraceback (most recent call last):')
+
+
+    def test_replaces_tempdir(self):
+        check = StreamingOutputCheck(
+            Output('F\n/.../superlists/lists/tests.py\nbla\nbla\nbla\n'), '/tmp/tmpxyz'
+        )
+        check('F\n')
+        check('/tmp/tmpxyz/superlists/lists/tests.py\n')  # should not raise
+
+
+    def test_only_enabled_for_exact_comparisons(self):
+        assert not StreamingOutputCheck(Output('OK\n'), '/tmp').enabled
+        assert not StreamingOutputCheck(
+            Output(self.expected.replace('F\n', '[...]\n')), '/tmp'
+        ).enabled
+        qunit = Output(self.expected)
+        qunit.qunit_output = True
+        assert not StreamingOutputCheck(qunit, '/tmp').enabled
+        StreamingOutputCheck(Output('OK\n'), '/tmp')('whatever\n')  # should not raise
+
+
 
 class CurrentContentsTest(ChapterTest):
 
@@ -956,6 +1267,22 @@ class CurrentContentsTest(ChapterTest):
             self.check_current_contents(listing2, actual_contents)
 
 
+class FixPhantomjsOutputTest(unittest.TestCase):
+
+    def test_rewrites_phantom_errors_firefox_style(self):
+        self.assertEqual(
+            fix_phantomjs_output(
+                "Died on test #1 at file:///tmp/tests.html:12: Can't find variable: Superlists\n"
+                "'undefined' is not an object (evaluating 'Superlists.Accounts')\n"
+                "'undefined' is not a function (evaluating 'navigator.id.watch()')"
+            ),
+            "Died on test #1 @file:///tmp/tests.html:12: Superlists is not defined\n"
+            "Superlists is undefined\n"
+            "navigator.id.watch is not a function"
+        )
+
+
+
 class SplitBlocksTest(unittest.TestCase):
 
     def test_splits_on_multi_newlines(self):
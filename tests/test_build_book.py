@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+from textwrap import dedent
+
+from lxml import html
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from build_book import (  # noqa: E402
+    COUNTERS,
+    build_toc,
+    count_numerals,
+    dedupe_ids,
+    fix_xrefs,
+    parse_book,
+    renumber_footnotes,
+    stitch,
+)
+
+
+# what asciidoctor 2 gives for `-a toc` with just the book header, and
+# for chapters rendered with -e, each numbering its footnotes from 1
+SHELL = dedent(
+    """
+    <!DOCTYPE html>
+    <html lang="en">
+    <head>
+    <meta charset="UTF-8">
+    <meta name="generator" content="Asciidoctor 2.0.10">
+    <title>Test-Driven Development with Python</title>
+    </head>
+    <body class="book">
+    <div id="header">
+    <h1>Test-Driven Development with Python</h1>
+    </div>
+    <div id="content">
+
+    </div>
+    <div id="footer">
+    <div id="footer-text">
+    Last updated 2019-01-01 12:00:00 +0000
+    </div>
+    </div>
+    </body>
+    </html>
+    """
+).strip()
+
+PREFACE = dedent(
+    """
+    <div class="sect1">
+    <h2 id="_preface">Preface</h2>
+    <div class="sectionbody">
+    <div class="sect2">
+    <h3 id="_why_i_wrote_a_book_about_test_driven_development">Why I Wrote a Book About Test-Driven Development</h3>
+    <div class="paragraph">
+    <p>Testing Goat.<sup class="footnote">[<a id="_footnoteref_1" class="footnote" href="#_footnotedef_1" title="View footnote.">1</a>]</sup></p>
+    </div>
+    </div>
+    </div>
+    </div>
+    <div id="footnotes">
+    <hr>
+    <div class="footnote" id="_footnotedef_1">
+    <a href="#_footnoteref_1">1</a>. Obey it.
+    </div>
+    </div>
+    """
+).strip()
+
+PART = dedent(
+    """
+    <h1 id="part1" class="sect0">The Basics of TDD and Django</h1>
+    <div class="openblock partintro">
+    <div class="content">
+    <div class="paragraph">
+    <p>In this first part, I&#8217;m going to introduce the basics of TDD.</p>
+    </div>
+    </div>
+    </div>
+    """
+).strip()
+
+CHAPTER_01 = dedent(
+    """
+    <div class="sect1">
+    <h2 id="chapter_01">1. Getting Django Set Up Using a Functional Test</h2>
+    <div class="sectionbody">
+    <div class="sect2">
+    <h3 id="_obey_the_testing_goat_do_nothing_until_you_have_a_test">1.1. Obey the Testing Goat! Do Nothing Until You Have a Test</h3>
+    <div class="paragraph">
+    <p>See <a href="#chapter_02">[chapter_02]</a> and <a href="#first-ft">[first-ft]</a>.<sup class="footnote">[<a id="_footnoteref_1" class="footnote" href="#_footnotedef_1" title="View footnote.">1</a>]</sup></p>
+    </div>
+    <div id="first-ft" class="listingblock sourcecode">
+    <div class="title">functional_tests.py</div>
+    <div class="content">
+    <pre class="CodeRay highlight"><code data-lang="python">browser = webdriver.Firefox()</code></pre>
+    </div>
+    </div>
+    </div>
+    <div class="sect2">
+    <h3 id="_recap">1.2. Recap</h3>
+    <div class="paragraph">
+    <p>Back to <a href="#_recap">Recap</a>.</p>
+    </div>
+    </div>
+    </div>
+    </div>
+    <div id="footnotes">
+    <hr>
+    <div class="footnote" id="_footnotedef_1">
+    <a href="#_footnoteref_1">1</a>. Or a goat.
+    </div>
+    </div>
+    """
+).strip()
+
+CHAPTER_02 = dedent(
+    """
+    <div class="sect1">
+    <h2 id="chapter_02">2. Extending Our Functional Test Using the unittest Module</h2>
+    <div class="sectionbody">
+    <div class="sect2">
+    <h3 id="_recap">2.1. Recap</h3>
+    <div class="paragraph">
+    <p>Back to <a href="#_recap">Recap</a>, and on to <a href="#appendix_rest_api">[appendix_rest_api]</a>.<sup class="footnote">[<a id="_footnoteref_1" class="footnote" href="#_footnotedef_1" title="View footnote.">1</a>]</sup></p>
+    </div>
+    </div>
+    </div>
+    </div>
+    <div id="footnotes">
+    <hr>
+    <div class="footnote" id="_footnotedef_1">
+    <a href="#_footnoteref_1">1</a>. Another one.
+    </div>
+    </div>
+    """
+).strip()
+
+APPENDIX = dedent(
+    """
+    <div class="sect1">
+    <h2 id="appendix_rest_api">Appendix B: Building a REST API: JSON, Ajax, and Mocking with JavaScript</h2>
+    <div class="sectionbody">
+    <div class="sect2">
+    <h3 id="_recap">B.1. Recap</h3>
+    </div>
+    </div>
+    </div>
+    """
+).strip()
+
+
+class ParseBookTest(unittest.TestCase):
+
+    def test_splits_the_real_book_into_header_and_includes(self):
+        header, includes, attributes = parse_book(os.path.join(ROOT, 'book.asciidoc'))
+        self.assertIn('= Test-Driven Development with Python\n', header)
+        self.assertIn(':toc:\n', header)
+        self.assertNotIn('include::', header)
+
+        paths = [path for path, _ in includes]
+        self.assertEqual(paths[0], 'praise.harry.asciidoc')
+        self.assertIn('chapter_01.asciidoc', paths)
+        self.assertEqual(paths[-1], 'bibliography.asciidoc')
+
+        include_attributes = dict(includes)
+        self.assertEqual(include_attributes['preface.asciidoc']['sectnums'], None)
+        self.assertEqual(include_attributes['chapter_01.asciidoc']['sectnums'], '')
+        self.assertEqual(include_attributes['chapter_01.asciidoc']['doctype'], 'book')
+        self.assertEqual(attributes['source-highlighter'], 'coderay')
+
+
+    def test_warns_about_text_between_includes(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.asciidoc', delete=False) as f:
+            f.write('= Book\n\ninclude::a.asciidoc[]\nstray text\ninclude::b.asciidoc[]\n')
+        self.addCleanup(os.remove, f.name)
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            header, includes, _ = parse_book(f.name)
+        self.assertEqual(header, '= Book\n\n')
+        self.assertEqual([path for path, _ in includes], ['a.asciidoc', 'b.asciidoc'])
+        self.assertIn('ignoring text between includes', stdout.getvalue())
+        self.assertIn('stray text', stdout.getvalue())
+
+
+
+class CountNumeralsTest(unittest.TestCase):
+
+    def test_picks_up_chapter_numbers(self):
+        counters = dict.fromkeys(COUNTERS)
+        counters = count_numerals(CHAPTER_01, counters)
+        self.assertEqual(counters['chapter-number'], 1)
+        counters = count_numerals(CHAPTER_02, counters)
+        self.assertEqual(counters['chapter-number'], 2)
+
+
+    def test_footnotes_are_not_counters(self):
+        # so adding one doesn't change every later chapter's cache key
+        self.assertNotIn('footnote-number', COUNTERS)
+
+
+    def test_picks_up_appendix_letters_and_keeps_the_rest(self):
+        counters = {'chapter-number': 2, 'appendix-number': None}
+        self.assertEqual(
+            count_numerals(APPENDIX, counters),
+            {'chapter-number': 2, 'appendix-number': 'B'},
+        )
+        self.assertIsNone(counters['appendix-number'])  # not changed in place
+
+
+    def test_unnumbered_sections_leave_chapter_numbers_alone(self):
+        counters = count_numerals(PREFACE, dict.fromkeys(COUNTERS))
+        self.assertIsNone(counters['chapter-number'])
+
+
+
+class RenumberFootnotesTest(unittest.TestCase):
+
+    def test_carries_numbering_on_from_earlier_fragments(self):
+        fragment = html.fragment_fromstring(CHAPTER_01, create_parent='div')
+        self.assertEqual(renumber_footnotes(fragment, 4), 5)
+        ref = fragment.cssselect('sup.footnote a')[0]
+        self.assertEqual((ref.get('id'), ref.get('href'), ref.text), (
+            '_footnoteref_5', '#_footnotedef_5', '5'
+        ))
+        footnote = fragment.cssselect('#footnotes div.footnote')[0]
+        self.assertEqual(footnote.get('id'), '_footnotedef_5')
+        self.assertEqual(footnote[0].get('href'), '#_footnoteref_5')
+        self.assertEqual(footnote[0].text, '5')
+
+
+    def test_fragments_without_footnotes_leave_numbering_alone(self):
+        fragment = html.fragment_fromstring(APPENDIX, create_parent='div')
+        self.assertEqual(renumber_footnotes(fragment, 3), 3)
+
+
+
+class DedupeIdsTest(unittest.TestCase):
+
+    def test_suffixes_repeated_ids_and_their_links(self):
+        seen_ids = set()
+        first = html.fragment_fromstring(CHAPTER_01, create_parent='div')
+        dedupe_ids(first, seen_ids)
+        self.assertEqual(first.cssselect('h3')[1].get('id'), '_recap')
+
+        second = html.fragment_fromstring(CHAPTER_02, create_parent='div')
+        dedupe_ids(second, seen_ids)
+        self.assertEqual(second.cssselect('h3')[0].get('id'), '_recap_2')
+        self.assertEqual(second.cssselect('a[href^="#_recap"]')[0].get('href'), '#_recap_2')
+        # ids that were unique are untouched
+        self.assertEqual(second.cssselect('h2')[0].get('id'), 'chapter_02')
+
+        third = html.fragment_fromstring(APPENDIX, create_parent='div')
+        dedupe_ids(third, seen_ids)
+        self.assertEqual(third.cssselect('h3')[0].get('id'), '_recap_3')
+
+
+
+class FixXrefsTest(unittest.TestCase):
+
+    def test_fills_in_unresolved_xrefs_from_their_targets(self):
+        content = html.fragment_fromstring(CHAPTER_01 + CHAPTER_02, create_parent='div')
+        fix_xrefs(content)
+        links = {link.get('href'): link.text_content() for link in content.cssselect('p a')}
+        # section numerals come off, block titles are used as they are
+        self.assertEqual(links['#chapter_02'], 'Extending Our Functional Test Using the unittest Module')
+        self.assertEqual(links['#first-ft'], 'functional_tests.py')
+        # xrefs asciidoctor already resolved are left alone
+        self.assertEqual(links['#_recap'], 'Recap')
+
+
+    def test_leaves_xrefs_to_missing_targets(self):
+        content = html.fragment_fromstring(CHAPTER_02, create_parent='div')
+        fix_xrefs(content)
+        link = content.cssselect('a[href="#appendix_rest_api"]')[0]
+        self.assertEqual(link.text_content(), '[appendix_rest_api]')
+
+
+    def test_strips_appendix_numerals(self):
+        content = html.fragment_fromstring(CHAPTER_02 + APPENDIX, create_parent='div')
+        fix_xrefs(content)
+        link = content.cssselect('a[href="#appendix_rest_api"]')[0]
+        self.assertEqual(
+            link.text_content(),
+            'Building a REST API: JSON, Ajax, and Mocking with JavaScript',
+        )
+
+
+
+class BuildTocTest(unittest.TestCase):
+
+    def test_nests_chapters_under_parts_and_sections_under_chapters(self):
+        content = html.fragment_fromstring(
+            PREFACE + PART + CHAPTER_01 + APPENDIX, create_parent='div'
+        )
+        toc = build_toc(content, 'Table of Contents')
+        self.assertEqual(toc.get('id'), 'toc')
+        self.assertEqual(toc.cssselect('#toctitle')[0].text, 'Table of Contents')
+
+        # like asciidoctor's outline, a list is named after the level of its
+        # first entry, so the preface and the part share a sectlevel1 list
+        top = toc.cssselect('#toc > ul')
+        self.assertEqual([ul.get('class') for ul in top], ['sectlevel1'])
+        preface, part = top[0].cssselect(':scope > li')
+        self.assertEqual(preface.cssselect('a')[0].get('href'), '#_preface')
+        self.assertEqual(part.cssselect(':scope > a')[0].get('href'), '#part1')
+        chapters = part.cssselect(':scope > ul.sectlevel1 > li > a')
+        self.assertEqual(
+            [a.text for a in chapters],
+            [
+                '1. Getting Django Set Up Using a Functional Test',
+                'Appendix B: Building a REST API: JSON, Ajax, and Mocking with JavaScript',
+            ]
+        )
+        sections = part.cssselect('ul.sectlevel1 > li')[0].cssselect('ul.sectlevel2 > li > a')
+        self.assertEqual([a.get('href') for a in sections], [
+            '#_obey_the_testing_goat_do_nothing_until_you_have_a_test', '#_recap'
+        ])
+
+
+
+class StitchTest(unittest.TestCase):
+
+    def test_stitches_fragments_into_the_shell(self):
+        page = html.document_fromstring(stitch(
+            SHELL, [PREFACE, CHAPTER_01, CHAPTER_02, APPENDIX], 'Table of Contents'
+        ))
+        content = page.get_element_by_id('content')
+        self.assertEqual(
+            [h2.get('id') for h2 in content.cssselect('div.sect1 > h2')],
+            ['_preface', 'chapter_01', 'chapter_02', 'appendix_rest_api'],
+        )
+
+        ids = [element.get('id') for element in page.cssselect('[id]')]
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertIn('_recap_3', ids)
+
+        # one list of footnotes, after the content
+        footnotes = page.cssselect('#footnotes')
+        self.assertEqual(len(footnotes), 1)
+        self.assertEqual(footnotes[0].getprevious(), content)
+        self.assertEqual(
+            [div.get('id') for div in footnotes[0].cssselect('div.footnote')],
+            ['_footnotedef_1', '_footnotedef_2', '_footnotedef_3'],
+        )
+        self.assertEqual(
+            [(a.get('href'), a.text) for a in content.cssselect('sup.footnote a')],
+            [('#_footnotedef_1', '1'), ('#_footnotedef_2', '2'), ('#_footnotedef_3', '3')],
+        )
+
+        # xrefs across fragments are resolved
+        link = content.cssselect('a[href="#appendix_rest_api"]')[0]
+        self.assertEqual(
+            link.text_content(),
+            'Building a REST API: JSON, Ajax, and Mocking with JavaScript',
+        )
+
+        toc = page.cssselect('#header > #toc')[0]
+        self.assertEqual(len(toc.cssselect('ul.sectlevel1 > li')), 4)
+        self.assertEqual(page.cssselect('#header > h1')[0].text, 'Test-Driven Development with Python')
+
+
+if __name__ == '__main__':
+    unittest.main()
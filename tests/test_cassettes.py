@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+import unittest
+
+from cassettes import Cassette, CassetteMiss, tree_hash
+from sourcetree import SourceTree
+
+
+class TreeHashTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+    def test_changes_with_contents_but_ignores_git_and_pycs(self):
+        with open(os.path.join(self.tempdir, 'foo.py'), 'w') as f:
+            f.write('foo')
+        before = tree_hash(self.tempdir)
+        os.makedirs(os.path.join(self.tempdir, '.git'))
+        with open(os.path.join(self.tempdir, '.git', 'index'), 'w') as f:
+            f.write('stuff')
+        with open(os.path.join(self.tempdir, 'foo.pyc'), 'w') as f:
+            f.write('stuff')
+        self.assertEqual(tree_hash(self.tempdir), before)
+
+        with open(os.path.join(self.tempdir, 'foo.py'), 'w') as f:
+            f.write('bar')
+        self.assertNotEqual(tree_hash(self.tempdir), before)
+
+
+
+class CassetteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'cassettes', 'chapter_01.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+    def test_record_and_replay_through_sourcetree(self):
+        command = 'python3 -c "open(\'lists.py\', \'w\').write(\'x = 1\'); import os; print(os.getcwd())"'
+        sourcetree = SourceTree()
+        os.makedirs(os.path.join(sourcetree.tempdir, 'superlists'))
+        sourcetree.cassette = Cassette(self.path, 'record', sourcetree.tempdir)
+        sourcetree.listing_pos = 3
+        recorded = sourcetree.run_command(command)
+        sourcetree.cassette.save()
+
+        replaying = SourceTree()
+        os.makedirs(os.path.join(replaying.tempdir, 'superlists'))
+        replaying.cassette = Cassette(self.path, 'replay', replaying.tempdir)
+        replaying.listing_pos = 3
+        replaying._run_command = None  # would blow up if called
+        output = replaying.run_command(command)
+        self.assertEqual(output, recorded.replace(sourcetree.tempdir, replaying.tempdir))
+        self.assertEqual(replaying.cassette.hash_mismatches, 0)
+        # and the file it made is back on disk
+        with open(os.path.join(replaying.tempdir, 'superlists', 'lists.py')) as f:
+            self.assertEqual(f.read(), 'x = 1')
+
+
+    def test_cheap_file_and_git_commands_run_for_real_on_replay(self):
+        Cassette(self.path, 'record', '/tmp/xyz').save()
+        sourcetree = SourceTree()
+        os.makedirs(os.path.join(sourcetree.tempdir, 'superlists'))
+        sourcetree.cassette = Cassette(self.path, 'replay', sourcetree.tempdir)
+        sourcetree.run_command('git init . && mkdir lists && touch lists/models.py')
+        self.assertTrue(os.path.exists(os.path.join(sourcetree.tempdir, 'superlists', '.git')))
+        output = sourcetree.run_command('git status --short -uall')
+        self.assertIn('lists/models.py', output)
+        self.assertEqual(sourcetree.cassette.entries, [])
+
+
+    def test_record_passes_line_checker_through(self):
+        sourcetree = SourceTree()
+        os.makedirs(os.path.join(sourcetree.tempdir, 'superlists'))
+        sourcetree.cassette = Cassette(self.path, 'record', sourcetree.tempdir)
+        seen = []
+        sourcetree.run_command('python3 -c "print(1); print(2)"', line_checker=seen.append)
+        self.assertEqual([line.strip() for line in seen], ['1', '2'])
+
+
+    def test_replays_repeated_commands_in_order(self):
+        cassette = Cassette(self.path, 'record', '/tmp/xyz')
+        cassette.record(1, 'git status', 'aaa', 'first')
+        cassette.record(1, 'git status', 'bbb', 'second')
+        cassette.save()
+
+        cassette = Cassette(self.path, 'replay', '/tmp/abc')
+        self.assertEqual(cassette.play(1, 'git status', 'bbb'), 'second')
+        self.assertEqual(cassette.play(1, 'git status', 'zzz'), 'first')
+        self.assertEqual(cassette.hash_mismatches, 1)
+        with self.assertRaises(CassetteMiss):
+            cassette.play(1, 'git status', 'aaa')
+
+
+if __name__ == '__main__':
+    unittest.main()
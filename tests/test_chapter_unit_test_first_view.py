@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import unittest
-import time
 
 from book_tester import (
     ChapterTest,
@@ -32,7 +31,7 @@ class Chapter3Test(ChapterTest):
         print(self.pos)
         assert 'manage.py startapp lists' in self.listings[self.pos]
         self.recognise_listing_and_process_it()
-        time.sleep(1)  # voodoo sleep, otherwise db.sqlite3 doesnt appear in CI sometimes
+        self.sleep(1)  # voodoo sleep, otherwise db.sqlite3 doesnt appear in CI sometimes
 
         while self.pos < final_ft:
             print(self.pos)
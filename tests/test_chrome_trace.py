@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from chrome_trace import Tracer, merge_traces
+from sourcetree import SourceTree, command_kind, trace_category
+
+
+class TracerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+    def test_does_nothing_when_disabled(self):
+        tracer = Tracer(None)
+        with tracer.span('foo', 'bar'):
+            pass
+        self.assertEqual(tracer.events, [])
+        self.assertIsNone(tracer.write())
+
+
+    def test_nested_spans_are_complete_events(self):
+        tracer = Tracer(self.tempdir)
+        with tracer.span('chapter_01', 'chapter'):
+            with tracer.span('test', 'listing', pos=3):
+                pass
+        inner, outer = tracer.events
+        self.assertEqual(inner['args'], {'pos': 3})
+        self.assertEqual(outer['ph'], 'X')
+        self.assertEqual(outer['pid'], os.getpid())
+        self.assertLessEqual(outer['ts'], inner['ts'])
+        self.assertGreaterEqual(outer['ts'] + outer['dur'], inner['ts'] + inner['dur'])
+
+
+    def test_merges_per_process_files(self):
+        tracer = Tracer(self.tempdir)
+        with tracer.span('foo', 'bar'):
+            pass
+        tracer.write()
+        with open(os.path.join(self.tempdir, 'trace-1.json'), 'w') as f:
+            json.dump({'traceEvents': [{'name': 'other', 'ph': 'X', 'pid': 1}]}, f)
+
+        output = os.path.join(self.tempdir, 'trace.json')
+        self.assertEqual(merge_traces(self.tempdir, output), 3)
+        with open(output) as f:
+            names = [e['name'] for e in json.load(f)['traceEvents']]
+        self.assertIn('other', names)
+        self.assertIn('foo', names)
+
+
+    def test_run_command_records_subprocess_and_invocation_spans(self):
+        tracer = Tracer(self.tempdir)
+        sourcetree = SourceTree()
+        with patch('sourcetree.TRACER', tracer):
+            sourcetree.run_command('git --version', cwd=sourcetree.tempdir)
+        invocation, subprocess_span = tracer.events
+        self.assertEqual(subprocess_span['name'], 'subprocess')
+        self.assertEqual(invocation['name'], 'git --version')
+        self.assertEqual(invocation['cat'], 'git')
+
+
+
+class CommandKindTest(unittest.TestCase):
+
+    def test_command_kinds(self):
+        self.assertEqual(command_kind('git diff -w repo/chapter_01'), 'git diff')
+        self.assertEqual(
+            command_kind('source ../virtualenv/bin/activate && python manage.py test lists'),
+            'manage.py test'
+        )
+        self.assertEqual(command_kind('python functional_tests.py'), 'python functional_tests.py')
+        self.assertEqual(command_kind('cd deploy_tools && fab deploy:host=foo'), 'fab')
+        self.assertEqual(command_kind('tree -I *.pyc --noreport'), 'tree')
+
+
+    def test_trace_categories(self):
+        self.assertEqual(trace_category('git show'), 'git')
+        self.assertEqual(trace_category('manage.py test'), 'django test')
+        self.assertEqual(trace_category('python functional_tests.py'), 'django test')
+        self.assertEqual(trace_category('manage.py migrate'), 'command')
+
+
+if __name__ == '__main__':
+    unittest.main()
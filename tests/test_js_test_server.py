@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import threading
+import time
+import unittest
+from unittest.mock import patch
+import urllib.parse
+
+import js_test_server
+from js_test_server import JSTestServer
+
+
+class SlowEchoHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        time.sleep(0.2)
+        path = urllib.parse.unquote(self.path.split('path=')[1])
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write('ran {}\n'.format(path).encode('utf8'))
+
+    def log_message(self, *args):
+        pass
+
+
+
+class JSTestServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.http_server = HTTPServer(('127.0.0.1', 0), SlowEchoHandler)
+        self.http_server.daemon_threads = True
+        threading.Thread(target=self.http_server.serve_forever, daemon=True).start()
+        self.server = JSTestServer()
+        self.server.port = self.http_server.server_address[1]
+
+    def tearDown(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
+
+
+    def test_run_sends_absolute_test_path(self):
+        self.assertEqual(self.server.run('/tmp/a b/tests.html'), 'ran /tmp/a b/tests.html\n')
+
+
+    def test_run_all_keeps_order(self):
+        self.assertEqual(
+            self.server.run_all(['/lists/tests.html', '/accounts/tests.html']),
+            ['ran /lists/tests.html\n', 'ran /accounts/tests.html\n'],
+        )
+
+
+
+class GetServerTest(unittest.TestCase):
+
+    def test_returns_none_and_stops_trying_if_phantomjs_cant_start(self):
+        with patch('js_test_server._server', None), \
+                patch('js_test_server._start_failed', False), \
+                patch('js_test_server.SERVER_SCRIPT', '/no/such/script.js'), \
+                patch('subprocess.Popen', side_effect=OSError('no phantomjs')) as mock_popen:
+            assert js_test_server.get_server() is None
+            assert js_test_server.get_server() is None
+        self.assertEqual(mock_popen.call_count, 1)
+
+
+    def test_can_be_switched_off(self):
+        with patch('js_test_server.ENABLED', False), \
+                patch('subprocess.Popen') as mock_popen:
+            assert js_test_server.get_server() is None
+        assert not mock_popen.called
+
+
+if __name__ == '__main__':
+    unittest.main()
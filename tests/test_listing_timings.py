@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from book_parser import Command, Output
+from listing_timings import ListingTimings
+from sourcetree import SourceTree
+
+
+class ListingTimingsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+    def test_records_commands_run_during_listing(self):
+        timings = ListingTimings('chapter_01')
+        sourcetree = SourceTree()
+        sourcetree.timings = timings
+        with timings.listing(3, Command('echo hello')):
+            sourcetree.run_command('echo hello', cwd=sourcetree.tempdir)
+            sourcetree.run_command('echo there', cwd=sourcetree.tempdir)
+        sourcetree.run_command('echo ignored', cwd=sourcetree.tempdir)
+
+        [record] = timings.records
+        self.assertEqual(record['pos'], 3)
+        self.assertEqual(record['type'], 'other command')
+        self.assertEqual(record['processes'], 2)
+        self.assertEqual(record['output_size'], len('hello\nthere\n'))
+        self.assertGreater(record['wall_time'], 0)
+
+
+    def test_writes_json_lines(self):
+        timings = ListingTimings('chapter_01')
+        with timings.listing(0, Output('foo')):
+            pass
+        with timings.listing(1, Output('bar')):
+            pass
+        path = timings.write(os.path.join(self.tempdir, 'timings', 'chapter_01.jsonl'))
+        with open(path) as f:
+            records = [json.loads(l) for l in f]
+        self.assertEqual([r['pos'] for r in records], [0, 1])
+
+
+    def test_summary_lists_slowest_first(self):
+        timings = ListingTimings('chapter_01')
+        timings.records = [
+            dict(pos=0, type='test', listing='a', processes=1, output_size=10,
+                 wall_time=0.5, child_cpu_time=0.4),
+            dict(pos=1, type='test', listing='b', processes=1, output_size=10,
+                 wall_time=2.5, child_cpu_time=2.0),
+        ]
+        summary = timings.summary().split('\n')
+        self.assertIn('2 listings, 3.0s total', summary[0])
+        self.assertTrue(summary[2].strip().startswith('1 '))
+        self.assertTrue(summary[3].strip().startswith('0 '))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+import random
+import unittest
+
+from output_diff import (
+    format_mismatch,
+    group_opcodes,
+    normalised_line_numbers,
+    patience_opcodes,
+)
+
+
+def apply_opcodes(a, b, opcodes):
+    result = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal':
+            assert a[i1:i2] == b[j1:j2]
+        result.extend(b[j1:j2])
+    return result
+
+
+class PatienceOpcodesTest(unittest.TestCase):
+
+    def test_opcodes_cover_both_sides_in_order(self):
+        rng = random.Random(0)
+        for _ in range(500):
+            a = [rng.choice('abcde') for _ in range(rng.randint(0, 12))]
+            b = [rng.choice('abcde') for _ in range(rng.randint(0, 12))]
+            opcodes = patience_opcodes(a, b)
+            self.assertEqual(apply_opcodes(a, b, opcodes), b)
+            self.assertEqual(opcodes[-1][2], len(a))
+            self.assertEqual(opcodes[-1][4], len(b))
+
+
+    def test_aligns_on_unique_lines(self):
+        a = ['{', 'foo', '}', '{', 'bar', '}']
+        b = ['{', 'bar', '}']
+        self.assertEqual(patience_opcodes(a, b), [
+            ('equal', 0, 1, 0, 1),
+            ('delete', 1, 4, 1, 1),
+            ('equal', 4, 6, 1, 3),
+        ])
+
+
+    def test_no_groups_when_equal(self):
+        self.assertEqual(group_opcodes(patience_opcodes(['a', 'b'], ['a', 'b'])), [])
+
+
+
+class FormatMismatchTest(unittest.TestCase):
+
+    def test_shows_only_context_around_differences(self):
+        expected = ['line {}'.format(i) for i in range(100)]
+        actual = list(expected)
+        actual[50] = 'changed'
+        report = format_mismatch(expected, actual)
+        self.assertIn('@@ expected 48-54, actual 48-54 @@', report)
+        self.assertIn('-  line 50\n+  changed', report)
+        self.assertIn('   line 47\n', report)
+        self.assertNotIn('line 46', report)
+        self.assertNotIn('line 54', report)
+
+
+    def test_marks_normalised_lines(self):
+        report = format_mismatch(
+            ['Ran 1 tests in X.Xs', 'OK'], ['Ran 1 tests in X.Xs', 'FAILED'],
+            actual_normalised={0},
+        )
+        self.assertIn(' * Ran 1 tests in X.Xs', report)
+        self.assertIn('-  OK\n+  FAILED', report)
+
+
+    def test_normalised_line_numbers(self):
+        self.assertEqual(
+            normalised_line_numbers(['  foo', 'Ran 1 tests in X.Xs'], '  foo\nRan 1 test in 0.01s'),
+            {1},
+        )
+
+
+    def test_stays_short_on_huge_outputs(self):
+        expected = ['  File "foo.py", line {}, in bar'.format(i % 7) for i in range(20000)]
+        actual = ['  File "foo.py", line {}, in baz'.format(i % 7) for i in range(20000)]
+        report = format_mismatch(expected, actual)
+        assert len(report.split('\n')) < 200
+        self.assertIn('more lines]', report)
+
+
+if __name__ == '__main__':
+    unittest.main()
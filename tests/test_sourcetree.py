@@ -1,15 +1,26 @@
 import unittest
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 import subprocess
+import tempfile
+import time
 from textwrap import dedent
 import os
+import shutil
 
 from book_parser import CodeListing
+from listing_timings import ListingTimings
 from sourcetree import (
     BOOTSTRAP_WGET,
     ApplyCommitException,
-    Commit, SourceTree,
+    Commit, FileOverlay, ProcessRegistry, SourceTree,
     check_indentation,
+    clone_tree,
+    get_cached_pyc_dir,
+    get_interpreter_info,
+    get_pycache_prefix,
+    get_shared_virtualenv_path,
+    get_workspace_root,
+    make_workspace,
     get_offset,
     strip_comments,
 )
@@ -25,6 +36,70 @@ class GetFileTest(unittest.TestCase):
         assert sourcetree.get_contents('foo.txt') == 'bla bla'
 
 
+    def test_get_contents_sees_pending_writes(self):
+        sourcetree = SourceTree()
+        sourcetree.overlay.write(sourcetree.tempdir + '/superlists/foo.txt', 'pending')
+        assert sourcetree.get_contents('foo.txt') == 'pending'
+
+
+
+class WorkspaceRootTest(unittest.TestCase):
+
+    def test_can_force_disk_or_a_directory(self):
+        with patch('sourcetree.WORKSPACE_ROOT', 'disk'):
+            assert get_workspace_root() is None
+        with patch('sourcetree.WORKSPACE_ROOT', '/some/where'):
+            assert get_workspace_root() == '/some/where'
+
+
+    def test_prefers_shm_when_there_is_room(self):
+        shm = tempfile.mkdtemp()
+        with patch('sourcetree.SHM_PATH', shm), \
+                patch('sourcetree.MIN_WORKSPACE_FREE', 1), \
+                patch('sourcetree.available_memory', lambda: 100):
+            assert get_workspace_root() == shm
+            assert make_workspace().startswith(shm + '/')
+        shutil.rmtree(shm)
+
+
+    def test_falls_back_to_disk_when_short_of_space_or_memory(self):
+        shm = tempfile.mkdtemp()
+        with patch('sourcetree.SHM_PATH', shm), \
+                patch('sourcetree.MIN_WORKSPACE_FREE', 10 ** 18):
+            assert get_workspace_root() is None
+        with patch('sourcetree.SHM_PATH', shm), \
+                patch('sourcetree.MIN_WORKSPACE_FREE', 1000), \
+                patch('sourcetree.available_memory', lambda: 10):
+            assert get_workspace_root() is None
+        with patch('sourcetree.SHM_PATH', '/no/such/dir'):
+            assert get_workspace_root() is None
+        shutil.rmtree(shm)
+
+
+    def test_falls_back_to_disk_if_workspace_cant_be_made(self):
+        with patch('sourcetree.WORKSPACE_ROOT', '/no/such/dir'):
+            workspace = make_workspace()
+        assert os.path.isdir(workspace)
+        shutil.rmtree(workspace)
+
+
+
+class FileOverlayTest(unittest.TestCase):
+
+    def test_only_fsyncs_outside_tempdirs(self):
+        assert not FileOverlay(tempfile.mkdtemp()).fsync
+        assert not FileOverlay('/dev/shm/tmpxyz').fsync
+        assert FileOverlay(os.path.expanduser('~/somewhere')).fsync
+
+
+    def test_run_command_flushes_pending_writes_first(self):
+        sourcetree = SourceTree()
+        sourcetree.overlay.write(sourcetree.tempdir + '/superlists/foo.txt', 'bla')
+        output = sourcetree.run_command('cat superlists/foo.txt', cwd=sourcetree.tempdir)
+        assert output == 'bla'
+        assert 'foo.txt' not in str(sourcetree.overlay.pending)
+
+
 class StripCommentTest(unittest.TestCase):
 
     def test_strips_python_comments(self):
@@ -69,6 +144,124 @@ class StartWithCheckoutTest(unittest.TestCase):
 
 
 
+class StartStateCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.repo = os.path.join(self.tempdir, 'repo')
+        os.makedirs(self.repo)
+        for command in [
+            'git init -q .',
+            'git checkout -q -b chapter_16',
+            'echo "file 1" > file1.txt',
+            'git add . && git -c user.name=x -c user.email=x commit -q -m one',
+            'git checkout -q -b chapter_17',
+            'echo "file 2" > file2.txt',
+            'git add . && git -c user.name=x -c user.email=x commit -q -m two',
+        ]:
+            subprocess.check_call(command, shell=True, cwd=self.repo)
+        self.cache = os.path.join(self.tempdir, 'cache')
+        self.patcher = patch('sourcetree.START_STATE_CACHE', self.cache)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.tempdir)
+
+
+    def start(self):
+        sourcetree = SourceTree()
+        sourcetree.get_local_repo_path = lambda c: self.repo
+        sourcetree.start_with_checkout('chapter_17', 'chapter_16')
+        return sourcetree
+
+
+    def test_second_start_clones_cached_checkout(self):
+        first = self.start()
+        start_state = first.get_start_state_path('chapter_17', 'chapter_16')
+        assert os.path.exists(os.path.join(start_state, 'file1.txt'))
+        assert first.process_registry.counts['git init'] == 1
+
+        second = self.start()
+        assert second.process_registry.counts['git init'] == 0
+        assert second.get_contents('file1.txt') == 'file 1\n'
+        assert not os.path.exists(os.path.join(second.tempdir, 'superlists', 'file2.txt'))
+        diff = second.run_command('git diff repo/chapter_16')
+        assert diff == ''
+        assert 'file2.txt' in second.run_command('git diff --stat repo/chapter_17')
+
+
+    def test_keeps_only_the_newest_start_states_per_chapter(self):
+        chapter_cache = os.path.join(self.cache, 'chapter_17')
+        for age, name in enumerate(['chapter_16-aaa', 'chapter_16-bbb', 'chapter_16-ccc', 'database-ddd']):
+            os.makedirs(os.path.join(chapter_cache, name))
+            then = time.time() - 1000 * (age + 1)
+            os.utime(os.path.join(chapter_cache, name), (then, then))
+
+        first = self.start()
+        start_state = first.get_start_state_path('chapter_17', 'chapter_16')
+        assert sorted(os.listdir(chapter_cache)) == sorted([
+            os.path.basename(start_state), 'chapter_16-aaa', 'chapter_16-bbb', 'database-ddd'
+        ])
+
+
+    def test_migrated_database_is_cached_against_the_tree(self):
+        first = self.start()
+        cached = first.get_database_cache_path()
+        assert not first.restore_database(cached)
+        os.makedirs(os.path.join(first.tempdir, 'database'))
+        with open(os.path.join(first.tempdir, 'database', 'db.sqlite3'), 'w') as f:
+            f.write('migrated')
+        first.save_database(cached)
+
+        second = self.start()
+        assert second.get_database_cache_path() == cached
+        assert second.restore_database(cached)
+        with open(os.path.join(second.tempdir, 'database', 'db.sqlite3')) as f:
+            assert f.read() == 'migrated'
+
+        second.run_command('echo "class Item: pass" > models.py')
+        assert second.get_database_cache_path() != cached
+
+
+    def test_cache_key_changes_when_previous_branch_moves(self):
+        sourcetree = SourceTree()
+        sourcetree.get_local_repo_path = lambda c: self.repo
+        before = sourcetree.get_start_state_path('chapter_17', 'chapter_16')
+        subprocess.check_call(
+            'git checkout -q chapter_16 && touch new && git add new && '
+            'git -c user.name=x -c user.email=x commit -q -m new',
+            shell=True, cwd=self.repo,
+        )
+        assert sourcetree.get_start_state_path('chapter_17', 'chapter_16') != before
+        assert sourcetree.get_start_state_path('chapter_17', 'no_such_branch') is None
+
+
+    def test_changes_to_clone_dont_touch_cache(self):
+        self.start()
+        second = self.start()
+        second.run_command('echo "more" >> file1.txt')
+        start_state = second.get_start_state_path('chapter_17', 'chapter_16')
+        with open(os.path.join(start_state, 'file1.txt')) as f:
+            assert f.read() == 'file 1\n'
+
+
+    def test_clone_tree_copies_everything(self):
+        source = os.path.join(self.tempdir, 'source')
+        os.makedirs(os.path.join(source, '.git', 'objects', 'ab'))
+        with open(os.path.join(source, '.git', 'objects', 'ab', 'cdef'), 'w') as f:
+            f.write('object')
+        with open(os.path.join(source, 'foo.py'), 'w') as f:
+            f.write('foo')
+        target = os.path.join(self.tempdir, 'target')
+        clone_tree(source, target)
+        with open(os.path.join(target, '.git', 'objects', 'ab', 'cdef')) as f:
+            assert f.read() == 'object'
+        with open(os.path.join(target, 'foo.py')) as f:
+            assert f.read() == 'foo'
+
+
+
 class ApplyFromGitRefTest(unittest.TestCase):
 
     def setUp(self):
@@ -542,6 +735,33 @@ class SourceTreeRunCommandTest(unittest.TestCase):
         assert output.strip() == 'baz'
 
 
+    def test_line_checker_can_stop_a_command_early(self):
+        sourcetree = SourceTree()
+        seen = []
+        def line_checker(line):
+            seen.append(line)
+            if line == 'two\n':
+                raise AssertionError('nope')
+        start = time.time()
+        with self.assertRaises(AssertionError):
+            sourcetree.run_command(
+                'echo one; echo two; sleep 10; echo three',
+                cwd=sourcetree.tempdir, line_checker=line_checker,
+            )
+        assert time.time() - start < 5
+        self.assertEqual(seen, ['one\n', 'two\n'])
+
+
+    def test_line_checker_sees_all_output(self):
+        sourcetree = SourceTree()
+        seen = []
+        output = sourcetree.run_command(
+            'echo one; echo two >&2', cwd=sourcetree.tempdir, line_checker=seen.append,
+        )
+        self.assertEqual(output, 'one\ntwo\n')
+        self.assertEqual(seen, ['one\n', 'two\n'])
+
+
     def test_doesnt_raise_for_some_things_where_a_return_code_is_ok(self):
         sourcetree = SourceTree()
         sourcetree.run_command('diff foo bar', cwd=sourcetree.tempdir)
@@ -603,6 +823,152 @@ class SourceTreeRunCommandTest(unittest.TestCase):
         assert diff == ''
 
 
+class PycacheTest(unittest.TestCase):
+
+    def test_commands_compile_into_shared_pycache_prefix(self):
+        prefix = tempfile.mkdtemp()
+        sourcetree = SourceTree()
+        sourcetree.pycache_prefix = prefix
+        with open(os.path.join(sourcetree.tempdir, 'foo.py'), 'w') as f:
+            f.write('x = 1\n')
+        sourcetree.run_command('python3 -c "import foo"', cwd=sourcetree.tempdir)
+        assert not os.path.exists(os.path.join(sourcetree.tempdir, '__pycache__'))
+        pyc_dir = get_cached_pyc_dir(prefix, sourcetree.tempdir)
+        assert [f for f in os.listdir(pyc_dir) if f.startswith('foo.')]
+        sourcetree.cleanup()
+        assert not os.path.exists(pyc_dir)
+        shutil.rmtree(prefix)
+
+
+    def test_same_second_edits_are_picked_up(self):
+        prefix = tempfile.mkdtemp()
+        sourcetree = SourceTree()
+        sourcetree.pycache_prefix = prefix
+        foo = os.path.join(sourcetree.tempdir, 'foo.py')
+        for value in ('1', '2'):
+            # same size, and almost certainly the same second as the last compile
+            with open(foo, 'w') as f:
+                f.write('x = {}\n'.format(value))
+            output = sourcetree.run_command(
+                'python3 -c "import foo; print(foo.x)"', cwd=sourcetree.tempdir
+            )
+            assert output.strip() == value
+        sourcetree.cleanup()
+        shutil.rmtree(prefix)
+
+
+    def test_prefix_follows_the_python_on_path(self):
+        if get_interpreter_info() is None or get_interpreter_info()[1] < (3, 8):
+            self.skipTest('no python on PATH new enough for a pycache prefix')
+        assert get_pycache_prefix() is not None
+
+
+    def test_interpreter_is_only_asked_when_a_command_needs_it(self):
+        with patch.dict('sourcetree._interpreter_info', clear=True):
+            sourcetree = SourceTree()
+            assert sourcetree.process_registry.total == 0
+            sourcetree.run_command('true', cwd=sourcetree.tempdir)
+            assert sourcetree.process_registry.counts['python -c'] == 1
+            sourcetree.run_command('true', cwd=sourcetree.tempdir)
+            assert sourcetree.process_registry.counts['python -c'] == 1
+
+
+    def test_missing_interpreters_are_quiet(self):
+        with patch.dict('sourcetree._interpreter_info', clear=True):
+            registry = ProcessRegistry()
+            assert get_interpreter_info('python-that-isnt-there', registry) is None
+            assert registry.total == 0
+            assert get_interpreter_info('false', registry) is None
+            assert registry.counts == {'python -c': 1}
+
+
+    def test_prefix_is_keyed_on_the_chapter_interpreter(self):
+        with patch('sourcetree.get_interpreter_info', lambda python, process_registry=None: ('/usr/bin/python3.8', (3, 8, 1))):
+            prefix_38 = get_pycache_prefix()
+        with patch('sourcetree.get_interpreter_info', lambda python, process_registry=None: ('/usr/bin/python3.9', (3, 9, 0))):
+            prefix_39 = get_pycache_prefix()
+        assert prefix_38 != prefix_39
+
+
+    def test_no_prefix_for_pythons_that_ignore_it(self):
+        with patch('sourcetree.get_interpreter_info', lambda python, process_registry=None: ('/usr/bin/python3.6', (3, 6, 9))):
+            assert get_pycache_prefix() is None
+        with patch('sourcetree.get_interpreter_info', lambda python, process_registry=None: None):
+            assert get_pycache_prefix() is None
+
+
+    def test_keeps_dont_write_bytecode_without_a_prefix(self):
+        sourcetree = SourceTree()
+        sourcetree.pycache_prefix = None
+        with patch.dict(os.environ, {'PYTHONDONTWRITEBYTECODE': '1'}):
+            env = sourcetree.get_env()
+        assert env['PYTHONDONTWRITEBYTECODE'] == '1'
+        assert 'PYTHONPYCACHEPREFIX' not in env
+
+
+    def test_shared_virtualenv_is_keyed_on_interpreter_and_requirements(self):
+        requirements = tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False)
+        requirements.write('django==1.11\n')
+        requirements.close()
+        with patch('sourcetree.get_interpreter_info', lambda python, process_registry=None: ('/usr/bin/python3.6', (3, 6, 9))):
+            first = get_shared_virtualenv_path(requirements.name)
+            assert get_shared_virtualenv_path(requirements.name) == first
+        with patch('sourcetree.get_interpreter_info', lambda python, process_registry=None: ('/usr/bin/python3.8', (3, 8, 1))):
+            assert get_shared_virtualenv_path(requirements.name) != first
+        with open(requirements.name, 'a') as f:
+            f.write('selenium\n')
+        with patch('sourcetree.get_interpreter_info', lambda python, process_registry=None: ('/usr/bin/python3.6', (3, 6, 9))):
+            assert get_shared_virtualenv_path(requirements.name) != first
+        os.remove(requirements.name)
+
+
+
+class ProcessRegistryTest(unittest.TestCase):
+
+    def test_run_command_registers_processes_by_kind(self):
+        sourcetree = SourceTree()
+        sourcetree.pycache_prefix = None  # or asking the interpreter counts too
+        sourcetree.run_command('git init .', cwd=sourcetree.tempdir)
+        sourcetree.run_command('git status', cwd=sourcetree.tempdir)
+        sourcetree.run_command('git status', cwd=sourcetree.tempdir)
+        registry = sourcetree.process_registry
+        assert registry.total == 3
+        assert registry.counts == {'git init': 1, 'git status': 2}
+        assert registry.spawn_times['git status'] > 0
+
+
+    def test_check_output_registers_and_times_commands_outside_the_tree(self):
+        sourcetree = SourceTree()
+        sourcetree.timings = ListingTimings('chapter_x')
+        with sourcetree.timings.listing(0, Mock(type='server command')):
+            output = sourcetree.check_output(['echo', 'hi'], 'server command')
+        assert output == 'hi\n'
+        assert sourcetree.process_registry.counts == {'server command': 1}
+        assert sourcetree.timings.records[0]['processes'] == 1
+        with self.assertRaises(subprocess.CalledProcessError):
+            sourcetree.check_output(['false'], 'server command')
+
+
+    def test_summary(self):
+        registry = ProcessRegistry()
+        registry.record('git show', 0.5)
+        registry.record('git show', 0.25)
+        registry.record('tree', 0.25)
+        summary = registry.summary().split('\n')
+        assert summary[0] == '3 child processes, 1.00s spent spawning:'
+        assert summary[1].split() == ['2', '0.750s', 'git', 'show']
+
+
+    def test_over_budget(self):
+        registry = ProcessRegistry()
+        registry.record('git show', 0.1)
+        registry.record('git show', 0.1)
+        assert registry.over_budget(2) == {}
+        assert registry.over_budget(1) == {'total': (2, 1)}
+        assert registry.over_budget({'git show': 1, 'tree': 0}) == {'git show': (2, 1)}
+
+
+
 class CommitTest(unittest.TestCase):
 
     def test_init_from_example(self):
@@ -7,6 +7,7 @@ import tempfile
 
 from book_tester import CodeListing
 
+from sourcetree import FileOverlay
 from write_to_file import (
     _find_last_line_for_class,
     number_of_identical_chars,
@@ -1046,5 +1047,49 @@ class WriteToFileTest(unittest.TestCase):
 
 
 
+class WriteToFileOverlayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.overlay = FileOverlay(self.tempdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+    def test_keeps_writes_in_memory_until_flush(self):
+        listing = CodeListing(filename='lists/foo.py', contents='abc\ndef')
+        write_to_file(listing, self.tempdir, overlay=self.overlay)
+        path = os.path.join(self.tempdir, 'lists', 'foo.py')
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.overlay.read(path), 'abc\ndef\n')
+
+        self.overlay.flush()
+        with open(path) as f:
+            self.assertEqual(f.read(), 'abc\ndef\n')
+        self.assertNotIn(path, self.overlay)
+
+
+    def test_consecutive_listings_build_on_pending_contents(self):
+        path = os.path.join(self.tempdir, 'foo.py')
+        with open(path, 'w') as f:
+            f.write('import sys\n\n\ndef foo():\n    return 1\n')
+        write_to_file(
+            CodeListing(filename='foo.py', contents='def foo():\n    return 2\n'),
+            self.tempdir, overlay=self.overlay,
+        )
+        write_to_file(
+            CodeListing(filename='foo.py', contents='import os\n[...]\ndef foo():'),
+            self.tempdir, overlay=self.overlay,
+        )
+        with open(path) as f:
+            self.assertEqual(f.read(), 'import sys\n\n\ndef foo():\n    return 1\n')
+
+        self.overlay.flush()
+        with open(path) as f:
+            self.assertEqual(f.read(), 'import os\nimport sys\n\ndef foo():\n    return 2\n')
+
+
+
 if __name__ == '__main__':
     unittest.main()
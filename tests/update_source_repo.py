@@ -2,6 +2,10 @@ import subprocess
 import os
 import getpass
 
+from book_logging import get_logger
+
+log = get_logger('update_source_repo')
+
 REMOTE = 'local' if getpass.getuser() == 'harry' else 'origin'
 BASE_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -12,11 +16,11 @@ def fetch_if_possible(target_dir):
         stdout=subprocess.PIPE, stderr=subprocess.PIPE
     )
     stdout, stderr = fetch.communicate()
-    print(stdout.decode(), stderr.decode())
+    log.debug('%s %s', stdout.decode(), stderr.decode())
     if fetch.returncode:
         if 'Name or service not known' in stderr.decode() or 'Could not resolve' in stderr.decode():
             # no internet
-            print('No Internet')
+            log.warning('No Internet')
             return False
         raise Exception("Error running git fetch")
     return True
@@ -27,7 +31,7 @@ def update_sources_for_chapter(chapter, previous_chapter):
     source_dir = os.path.join(
         BASE_FOLDER, 'source', chapter, 'superlists'
     )
-    print('updating', source_dir)
+    log.info('updating %s', source_dir)
     subprocess.check_output(['git', 'submodule', 'update', source_dir])
     commit_specified_by_submodule = subprocess.check_output(
         ['git', 'log', '-n 1', '--format=%H'], cwd=source_dir
@@ -47,11 +51,11 @@ def update_sources_for_chapter(chapter, previous_chapter):
     if getpass.getuser() == 'jenkins':
         # if in CI, we use the submodule commit, to check that the submodule
         # config is up to date
-        print('resetting submodule to', commit_specified_by_submodule)
+        log.info('resetting submodule to %s', commit_specified_by_submodule)
         subprocess.check_output(
             ['git', 'reset', '--hard', commit_specified_by_submodule],
             cwd=source_dir
         )
     else:
-        print("skipping {} reset on dev machine".format(chapter))
+        log.debug("skipping %s reset on dev machine", chapter)
 
@@ -5,14 +5,17 @@ import os
 import re
 from textwrap import dedent
 
+from book_logging import get_logger
 from source_updater import (
     VIEW_FINDER,
     get_indent,
     Source,
 )
 
+log = get_logger('write_to_file')
+
 def _replace_lines_from_to(old_lines, new_lines, start_pos, end_pos):
-    print('replace lines from line', start_pos, 'to line', end_pos)
+    log.debug('replace lines from line %s to line %s', start_pos, end_pos)
     old_indent = get_indent(old_lines[start_pos])
     new_indent = get_indent(new_lines[0])
     if new_indent:
@@ -40,7 +43,7 @@ def _get_function(source, function_name):
 
 
 def _replace_lines_from(old_lines, new_lines, start_pos):
-    print('replace lines from line', start_pos)
+    log.debug('replace lines from line %s', start_pos)
     start_line_in_old = old_lines[start_pos]
     indent = get_indent(start_line_in_old)
     for ix, new_line in enumerate(new_lines):
@@ -69,7 +72,7 @@ def number_of_identical_chars(string1, string2):
 
 
 def _replace_single_line(old_lines, new_lines):
-    print('replace single line')
+    log.debug('replace single line')
     new_line = new_lines[0]
     line_finder = lambda l: number_of_identical_chars(l, new_line)
     likely_line = sorted(old_lines, key=line_finder)[-1]
@@ -88,7 +91,7 @@ def _replace_lines_in(old_lines, new_lines):
 
     start_pos = source.find_start_line(new_lines)
     if start_pos is None:
-        print('no start line found')
+        log.debug('no start line found')
         if 'import' in new_lines[0] and 'import' in old_lines[0]:
             new_contents = new_lines[0] + '\n'
             return new_contents + _replace_lines_in(old_lines[1:], new_lines[1:])
@@ -102,9 +105,9 @@ def _replace_lines_in(old_lines, new_lines):
 
         class_finder = re.compile(r'^class \w+\(.+\):$', re.MULTILINE)
         if class_finder.match(new_lines[0]):
-            print('found class in input')
+            log.debug('found class in input')
             if len(source.classes) > 1:
-                print('found classes')
+                log.debug('found classes')
                 return '\n'.join(old_lines) + '\n\n\n' + '\n'.join(new_lines)
 
         return '\n'.join(new_lines)
@@ -125,7 +128,7 @@ def _replace_lines_in(old_lines, new_lines):
 
 def add_import_and_new_lines(new_lines, old_lines):
     source = Source._from_contents('\n'.join(old_lines))
-    print('add import and new lines')
+    log.debug('add import and new lines')
     source.add_imports(new_lines[:1])
     lines_with_import = source.get_updated_contents().split('\n')
     new_lines_remaining = '\n'.join(new_lines[2:]).strip('\n').split('\n')
@@ -147,7 +150,7 @@ def _find_last_line_for_class(source, classname):
 
 
 def add_to_class(new_lines, old_lines):
-    print('adding to class')
+    log.debug('adding to class')
     source = Source._from_contents('\n'.join(old_lines))
     classname = re.search(r'class (\w+)\(\w+\):', new_lines[0]).group(1)
     source.add_to_class(classname, new_lines[2:])
@@ -155,7 +158,7 @@ def add_to_class(new_lines, old_lines):
 
 
 
-def write_to_file(codelisting, cwd):
+def write_to_file(codelisting, cwd, overlay=None):
     if ',' in codelisting.filename:
         files = codelisting.filename.split(', ')
     else:
@@ -163,19 +166,23 @@ def write_to_file(codelisting, cwd):
     new_contents = codelisting.contents
     for filename in files:
         path = os.path.join(cwd, filename)
-        _write_to_file(path, new_contents)
+        _write_to_file(path, new_contents, overlay=overlay)
         #with open(os.path.join(path)) as f:
         #    print(f.read())
     codelisting.was_written = True
 
 
-def _write_to_file(path, new_contents):
-    source = Source.from_path(path)
+def _write_to_file(path, new_contents, overlay=None):
+    if overlay is not None and path in overlay:
+        source = Source._from_contents(overlay.read(path))
+        source.path = path
+    else:
+        source = Source.from_path(path)
     # strip callouts
     new_contents = re.sub(r' +#$', '', new_contents, flags=re.MULTILINE)
     new_contents = re.sub(r' +//$', '', new_contents, flags=re.MULTILINE)
 
-    if not os.path.exists(path):
+    if not os.path.exists(path) and not (overlay is not None and path in overlay):
         dir = os.path.dirname(path)
         if not os.path.exists(dir):
             os.makedirs(dir)
@@ -235,5 +242,8 @@ def _write_to_file(path, new_contents):
     # strip trailing whitespace
     new_contents = re.sub(r'^ +$', '', new_contents, flags=re.MULTILINE)
     source.update(new_contents)
-    source.write()
+    if overlay is not None:
+        overlay.write(path, source.get_updated_contents())
+    else:
+        source.write()
 